@@ -1,12 +1,44 @@
 import sys
 import logging
 import argparse
+from typing import TYPE_CHECKING, Callable
 
-from auto_portforward.tui import ProcessMonitor
+if TYPE_CHECKING:
+    from auto_portforward.process_provider.abstract_provider import AbstractProvider
 
 LOGGER = logging.getLogger(__name__)
 
 
+# Each factory imports its provider itself, so only the chosen one is loaded
+def _make_local(args: argparse.Namespace) -> "AbstractProvider":
+    from auto_portforward.process_provider.local import LocalProcessMonitor
+
+    return LocalProcessMonitor()
+
+
+def _make_mock(args: argparse.Namespace) -> "AbstractProvider":
+    from auto_portforward.process_provider.local import MockProcessMonitor
+
+    return MockProcessMonitor()
+
+
+def _make_remote(args: argparse.Namespace) -> "AbstractProvider":
+    from auto_portforward.process_provider.ssh_remote import RemoteProcessMonitor
+
+    monitor = RemoteProcessMonitor(args.ssh_host)
+    if not monitor.connect():
+        LOGGER.error("Failed to establish connection. Exiting.")
+        sys.exit(1)
+    return monitor
+
+
+PROVIDERS: dict[str, Callable[[argparse.Namespace], "AbstractProvider"]] = {
+    "local": _make_local,
+    "mock": _make_mock,
+    "ssh": _make_remote,
+}
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=(
@@ -40,39 +72,33 @@ def main():
     )
     args = parser.parse_args()
 
-    if args.verbose:
-        root_logger = logging.getLogger()
-        root_logger.setLevel(logging.DEBUG)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
 
     if args.log_file:
         file_handler = logging.FileHandler(args.log_file)
         file_handler.setFormatter(
             logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
         )
-        root_logger = logging.getLogger()
         root_logger.addHandler(file_handler)
 
     if args.local:
-        from auto_portforward.process_provider.local import LocalProcessMonitor
-
-        monitor = LocalProcessMonitor()
+        kind = "local"
     elif args.mock:
-        from auto_portforward.process_provider.local import MockProcessMonitor
-
-        monitor = MockProcessMonitor()
+        kind = "mock"
     else:
         if not args.ssh_host:
             parser.error(
                 "SSH host is required when not using local or mock process monitor"
             )
             sys.exit(1)
+        kind = "ssh"
 
-        from auto_portforward.process_provider.ssh_remote import RemoteProcessMonitor
+    monitor = PROVIDERS[kind](args)
 
-        monitor = RemoteProcessMonitor(args.ssh_host)
-        if not monitor.connect():
-            LOGGER.error("Failed to establish connection. Exiting.")
-            sys.exit(1)
+    # Textual/Rich are only imported once the arguments are known to be valid,
+    # so `--help` and argument errors return without paying for them.
+    from auto_portforward.tui import ProcessMonitor
 
     app = ProcessMonitor(monitor)
     app.run()
@@ -1,12 +1,13 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Process:
     pid: int
     name: str
     cwd: str
     status: str
     create_time: str
-    tcp: list[int] = field(default_factory=list)
-    udp: list[int] = field(default_factory=list)
+    # sorted; tuples keep the instances immutable and hashable
+    tcp: tuple[int, ...] = ()
+    udp: tuple[int, ...] = ()
@@ -1,7 +1,7 @@
+import asyncio
 import logging
 
-from abc import ABC, abstractmethod
-from typing import Set
+from typing import Protocol, Set
 
 
 from auto_portforward import datatype
@@ -9,23 +9,74 @@ from auto_portforward import datatype
 LOGGER = logging.getLogger(__file__)
 
 
-class AbstractProvider(ABC):
+class AbstractProvider(Protocol):
+    """
+    What the TUI expects from a process provider. This is purely structural;
+    concrete providers get the shared behaviour from `BaseProvider`.
+    """
+
+    @property
+    def name(self) -> str: ...
+
+    # bumped whenever get_processes starts returning a different snapshot
+    version: int
+
+    # set along with every version bump, so that callers can wait for changes
+    changed: asyncio.Event
+
+    async def get_processes(self) -> dict[str, datatype.Process]: ...
+
+    async def cleanup(self) -> None: ...
+
+    def mark_changed(self) -> None: ...
+
+    async def refresh(self) -> None: ...
+
+    async def set_toggled_ports(self, ports: Set[int]) -> None: ...
+
+
+class BaseProvider:
+    """
+    Port on/off bookkeeping shared by the concrete providers, which only need
+    to implement `get_processes` (and the `on_ports_turned_*` hooks if
+    toggling a port should do something).
+    """
+
     def __init__(self):
         self.toggled_ports: Set[int] = set()
+        # bumped by subclasses whenever the snapshot changes, so that callers
+        # can tell whether anything changed without comparing the snapshots
+        self.version: int = 0
+        self.changed = asyncio.Event()
 
     @property
     def name(self) -> str:
         return self.__class__.__name__
 
-    @abstractmethod
-    async def get_processes(self) -> dict[str, datatype.Process]:
-        pass
-
     async def cleanup(self) -> None:
-        for port in self.toggled_ports:
-            await self.on_ports_turned_off(port)
+        await self._gather_logged(
+            *(self.on_ports_turned_off(port) for port in self.toggled_ports)
+        )
         self.toggled_ports.clear()
 
+    @staticmethod
+    async def _gather_logged(*coros) -> None:
+        # one failing port must neither cancel nor hide the others
+        for result in await asyncio.gather(*coros, return_exceptions=True):
+            if isinstance(result, Exception):
+                LOGGER.error("Error toggling port: %s", result)
+
+    def mark_changed(self) -> None:
+        """Record that get_processes now returns a different snapshot."""
+        self.version += 1
+        self.changed.set()
+
+    async def refresh(self) -> None:
+        """
+        Make the next get_processes reflect the current state as soon as
+        possible. Providers that collect on every call have nothing to do.
+        """
+
     async def on_ports_turned_on(self, port: int):
         LOGGER.info("Port %i is turned on", port)
 
@@ -36,14 +87,11 @@ class AbstractProvider(ABC):
         """
         This method is used to just manage ports on-off event.
         """
-
-        # Remove old port forwards
-        for existing in list(self.toggled_ports):
-            if existing not in ports:
-                await self.on_ports_turned_off(existing)
-                self.toggled_ports.remove(existing)
-        # Start new port forwards
-        for p in ports:
-            if p not in list(self.toggled_ports):
-                await self.on_ports_turned_on(p)
-                self.toggled_ports.add(p)
+        ports = set(ports)
+        # Toggling can be I/O bound (e.g. ssh for remote providers), so stale
+        # ports are turned off and new ones turned on concurrently.
+        await self._gather_logged(
+            *(self.on_ports_turned_off(p) for p in self.toggled_ports - ports),
+            *(self.on_ports_turned_on(p) for p in ports - self.toggled_ports),
+        )
+        self.toggled_ports = ports
@@ -1,5 +1,7 @@
 import os
+import re
 import socket
+import struct
 import sys
 import logging
 
@@ -16,11 +18,12 @@ except ImportError:
     HAS_PSUTIL = False
     LOGGER.info("psutil not found, using fallback methods")
 
-# If we are in ssh_single_file_mode
-# we directly inject the Process class
-# into the local namespace
+# In ssh_single_file_mode the processes are only turned into JSON, so plain
+# dicts do and datatype.py does not need to be shipped
 if not locals().get("ssh_single_file_mode", False):
     from ..datatype import Process
+else:
+    Process = dict
 
 
 def get_cwd_linux(pid: int) -> str:
@@ -54,69 +57,468 @@ def get_cwd_macos(pid: int) -> str:
     return "?"
 
 
-def get_cwd_fallback(pid: int) -> str:
-    if sys.platform.startswith("linux"):
-        return get_cwd_linux(pid)
-    elif sys.platform.startswith("darwin"):
-        return get_cwd_macos(pid)
-    else:
-        return "?"
+def get_cwd_unknown(pid: int) -> str:
+    return "?"
+
+
+# The platform cannot change while we run, so pick the implementations once
+IS_LINUX = sys.platform.startswith("linux")
+if IS_LINUX:
+    get_cwd_fallback = get_cwd_linux
+elif sys.platform.startswith("darwin"):
+    get_cwd_fallback = get_cwd_macos
+else:
+    get_cwd_fallback = get_cwd_unknown
+
+
+# Shell loop printing, for each pid given as argument, the pid and then its
+# cwd (an empty line if it cannot be read) on the next line.
+READLINK_CWDS_SCRIPT = (
+    "for p; do echo $p; readlink /proc/$p/cwd 2>/dev/null || echo; done"
+)
+
+
+def get_cwds_linux_sudo(pids: list[int], password: str) -> dict[int, str]:
+    """
+    Resolve the cwd of all `pids` with a single sudo invocation, instead of
+    paying for one fork/exec and sudo authentication per pid.
+    """
+    cmd = ["sudo", "-S", "sh", "-c", READLINK_CWDS_SCRIPT, "sh"]
+    cmd += [str(pid) for pid in pids]
+    cwds = {}
+    try:
+        result = subprocess.run(
+            cmd, input=password + "\n", capture_output=True, text=True, check=False
+        )
+    except Exception:
+        return cwds
+    if result.returncode == 0:
+        lines = result.stdout.splitlines()
+        for pid, cwd in zip(lines[::2], lines[1::2]):
+            if pid.isdigit():
+                cwds[int(pid)] = cwd or "?"
+    return cwds
+
+
+def get_cwds(pids: list[int]) -> dict[int, str]:
+    password = os.getenv("AP_SUDO_PASSWORD")
+    if password and IS_LINUX:
+        return get_cwds_linux_sudo(pids, password)
+    return {pid: get_cwd_fallback(pid) for pid in pids}
+
+
+# pid -> (create_time, name, cwd). These never change for a live process, so
+# they are only looked up again when a pid is seen with a new create_time.
+_static_cache: dict[int, tuple[str, str, str]] = {}
+
+
+def _process_row_psutil(pid: int) -> tuple[str, str, str, str | None] | None:
+    try:
+        proc = psutil.Process(pid)
+        # one read of /proc/<pid>/stat serves create_time, name and status
+        with proc.oneshot():
+            create_time = str(proc.create_time())
+            cached = _static_cache.get(pid)
+            if cached is not None and cached[0] == create_time:
+                _, name, cwd = cached
+            else:
+                name = proc.name()
+                try:
+                    cwd = proc.cwd()
+                except psutil.AccessDenied:
+                    cwd = "?"
+                _static_cache[pid] = (create_time, name, cwd)
+            status = proc.status()
+    except psutil.NoSuchProcess:
+        # exited since its sockets were listed
+        return None
+    return name, status, create_time, cwd
+
+
+def _process_row_ps(pid: int) -> tuple[str, str, str, str | None] | None:
+    # Fallback: basic info using single ps command
+    # Get process name, status, and start time (no cwd available)
+    cmd = ["ps", "-p", str(pid), "-o", "comm=,stat=,lstart="]
+    output = subprocess.check_output(cmd, text=True).strip()
+    if not output:
+        return None
+
+    parts = output.split()
+    name = parts[0]
+    status = parts[1]
+    create_time = " ".join(parts[2:])
+    cached = _static_cache.get(pid)
+    cwd = cached[2] if cached is not None and cached[0] == create_time else None
+    return name, status, create_time, cwd
+
+
+# pid -> (fields, Process) of the previous call. An unchanged process is
+# returned as the same object again, which callers can test with `is`.
+_last_processes: dict[int, tuple[tuple, Process]] = {}
 
 
 def get_processes(
-    connections: dict[int, list[int]], udp_connections: dict[int, list[int]]
+    connections: dict[int, tuple[int, ...]], udp_connections: dict[int, tuple[int, ...]]
 ) -> dict[int, Process]:
-    processes = {}
+    # pid -> (name, status, create_time, cwd); cwd is None while it still
+    # needs to be looked up, which is done for all such pids at once below
+    rows: dict[int, tuple[str, str, str, str | None]] = {}
 
     for pid in connections.keys() | udp_connections.keys():
-        try:
-            pid = int(pid)
-        except (ValueError, TypeError):
+        row = _process_row(pid)
+        if row is None:
             continue
+        rows[pid] = row
 
-        if HAS_PSUTIL:
-            proc = psutil.Process(pid)
-            p = Process(
-                pid=proc.pid,
-                name=proc.name(),
-                cwd=proc.cwd(),
-                status=proc.status(),
-                create_time=str(proc.create_time()),
-                tcp=sorted(connections.get(pid, [])),
-                udp=sorted(udp_connections.get(pid, [])),
-            )
-            processes[p.pid] = p
+    missing = [pid for pid, row in rows.items() if row[3] is None]
+    cwds = get_cwds(missing) if missing else {}
 
-        else:
-            # Fallback: basic info using single ps command
-            # Get process name, status, and start time (no cwd available)
-            cmd = ["ps", "-p", str(pid), "-o", "comm=,stat=,lstart="]
-            output = subprocess.check_output(cmd, text=True).strip()
-            if not output:
-                continue
-
-            parts = output.split()
-            name = parts[0]
-            status = parts[1]
-            create_time = " ".join(parts[2:])
+    global _last_processes
 
-            p = Process(
+    processes = {}
+    last_processes = {}
+    for pid, (name, status, create_time, cwd) in rows.items():
+        if cwd is None:
+            cwd = cwds.get(pid, "?")
+            _static_cache[pid] = (create_time, name, cwd)
+        tcp = connections.get(pid, ())
+        udp = udp_connections.get(pid, ())
+        key = (name, status, create_time, cwd, tcp, udp)
+        last = _last_processes.get(pid)
+        if last is not None and last[0] == key:
+            process = last[1]
+        else:
+            process = Process(
                 pid=pid,
                 name=name,
-                cwd=get_cwd_fallback(pid),
+                cwd=cwd,
                 status=status,
                 create_time=create_time,
-                tcp=sorted(connections.get(pid, [])),
-                udp=sorted(udp_connections.get(pid, [])),
+                tcp=tcp,
+                udp=udp,
             )
-            processes[p.pid] = p
+        processes[pid] = process
+        last_processes[pid] = (key, process)
+    _last_processes = last_processes
+
+    # forget processes that no longer listen on anything
+    for pid in _static_cache.keys() - processes.keys():
+        del _static_cache[pid]
 
     return processes
 
 
+# (protocol, socket table, state of the sockets we are interested in)
+# TCP 0A is LISTEN; UDP 07 is an unconnected (bound) socket, which includes
+# client sockets (see drop_client_udp_sockets).
+PROC_NET_TABLES = (
+    ("tcp", "/proc/net/tcp", "0A"),
+    ("tcp", "/proc/net/tcp6", "0A"),
+    ("udp", "/proc/net/udp", "07"),
+    ("udp", "/proc/net/udp6", "07"),
+)
+
+
+def read_listening_inodes_procfs() -> dict[str, tuple[str, int]]:
+    """
+    Map the inode of every listening socket to its (protocol, port) by reading
+    the kernel socket tables, which are only a few KB.
+    """
+    inodes = {}
+    for proto, path, state in PROC_NET_TABLES:
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()[1:]
+        except OSError:
+            # e.g. no tcp6 table when IPv6 is disabled
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10 or fields[3] != state:
+                continue
+            port = int(fields[1].rsplit(":", 1)[1], 16)
+            inodes[fields[9]] = (proto, port)
+    return inodes
+
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+# struct nlmsghdr
+NLMSG_HEADER = struct.Struct("=IHHII")
+# struct inet_diag_req_v2: family, protocol, extensions, pad, state bitmask
+# and an all-zero inet_diag_sockid (i.e. any address)
+INET_DIAG_REQ = struct.Struct("=BBBxI48x")
+# In struct inet_diag_msg, the source port (big-endian) and the inode
+INET_DIAG_SPORT = struct.Struct(">4xH")
+INET_DIAG_INODE = struct.Struct("=68xI")
+# (protocol, IPPROTO_*, state bitmask): LISTEN (10) for TCP, and CLOSE (7),
+# i.e. bound but unconnected, for UDP as in PROC_NET_TABLES
+SOCK_DIAG_QUERIES = (
+    ("tcp", socket.IPPROTO_TCP, 1 << 10),
+    ("udp", socket.IPPROTO_UDP, 1 << 7),
+)
+
+
+def _read_sock_diag_dump(
+    sock: socket.socket, proto: str, inodes: dict[str, tuple[str, int]]
+) -> None:
+    while True:
+        data = sock.recv(65536)
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+            if msg_type == NLMSG_DONE:
+                return
+            if msg_type == NLMSG_ERROR or length < NLMSG_HEADER.size:
+                raise OSError("sock_diag dump failed")
+            body = offset + NLMSG_HEADER.size
+            (port,) = INET_DIAG_SPORT.unpack_from(data, body)
+            (inode,) = INET_DIAG_INODE.unpack_from(data, body)
+            inodes[str(inode)] = (proto, port)
+            # messages are 4-byte aligned
+            offset += (length + 3) & ~3
+
+
+def read_listening_inodes_netlink() -> dict[str, tuple[str, int]]:
+    """
+    read_listening_inodes_procfs(), but the kernel filters the sockets by
+    state and sends them in binary, instead of us parsing a text line for
+    every socket on the host (most of them connections, not listeners).
+    """
+    inodes: dict[str, tuple[str, int]] = {}
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG) as sock:
+        for proto, protocol, states in SOCK_DIAG_QUERIES:
+            for family in (socket.AF_INET, socket.AF_INET6):
+                request = INET_DIAG_REQ.pack(family, protocol, 0, states)
+                header = NLMSG_HEADER.pack(
+                    NLMSG_HEADER.size + len(request),
+                    SOCK_DIAG_BY_FAMILY,
+                    NLM_F_REQUEST | NLM_F_DUMP,
+                    0,
+                    0,
+                )
+                sock.send(header + request)
+                _read_sock_diag_dump(sock, proto, inodes)
+    return inodes
+
+
+# cleared when netlink turns out not to work here (e.g. in some containers)
+_use_netlink = True
+
+# the kernel's default, for when the sysctl cannot be read
+DEFAULT_EPHEMERAL_PORTS = range(32768, 61000)
+_ephemeral_ports: range | None = None
+
+
+def ephemeral_port_range() -> range:
+    """The ports the kernel picks from when a socket is bound to port 0."""
+    global _ephemeral_ports
+
+    if _ephemeral_ports is None:
+        try:
+            with open("/proc/sys/net/ipv4/ip_local_port_range") as f:
+                low, high = map(int, f.read().split())
+            _ephemeral_ports = range(low, high + 1)
+        except (OSError, ValueError):
+            _ephemeral_ports = DEFAULT_EPHEMERAL_PORTS
+    return _ephemeral_ports
+
+
+def drop_client_udp_sockets(
+    inodes: dict[str, tuple[str, int]],
+) -> dict[str, tuple[str, int]]:
+    """
+    Every unconnected UDP socket is in the "listening" state, including the
+    short-lived client sockets of e.g. DNS resolvers and mDNS queries. Those
+    are bound to an ephemeral port, whereas services bind a fixed one.
+    """
+    ephemeral = ephemeral_port_range()
+    return {
+        inode: (proto, port)
+        for inode, (proto, port) in inodes.items()
+        if proto != "udp" or port not in ephemeral
+    }
+
+
+def read_listening_inodes() -> dict[str, tuple[str, int]]:
+    """Map the inode of every listening socket to its (protocol, port)."""
+    global _use_netlink
+
+    inodes = None
+    if _use_netlink:
+        try:
+            inodes = read_listening_inodes_netlink()
+        except (OSError, AttributeError, struct.error) as e:
+            LOGGER.info("sock_diag unavailable, reading /proc/net instead: %s", e)
+            _use_netlink = False
+    if inodes is None:
+        inodes = read_listening_inodes_procfs()
+    # dropped before the owners are resolved, so that client sockets coming
+    # and going do not trigger a walk over /proc/*/fd
+    return drop_client_udp_sockets(inodes)
+
+
+def find_socket_owners(inodes: dict[str, tuple[str, int]]) -> dict[str, int | None]:
+    """
+    Resolve socket inodes to pids by matching them against the
+    `socket:[<inode>]` links in /proc/<pid>/fd, which is what
+    psutil.net_connections() does for every socket on the host. Sockets of
+    processes we may not look at map to None.
+    """
+    owners: dict[str, int | None] = dict.fromkeys(inodes)
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        fd_dir = f"/proc/{entry}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # gone, or not ours to look at
+            continue
+        for fd in fds:
+            try:
+                link = os.readlink(f"{fd_dir}/{fd}")
+            except OSError:
+                continue
+            if not link.startswith("socket:["):
+                continue
+            inode = link[8:-1]
+            if inode in owners:
+                owners[inode] = int(entry)
+    return owners
+
+
+# inode -> pid of the listening sockets, from the last walk over /proc/*/fd.
+# It is only walked again when a socket shows up that we have not seen yet,
+# and every so often anyway, as a socket can change hands without that (e.g.
+# the parent exits after a fork).
+_socket_owners: dict[str, int | None] = {}
+_socket_owners_reused = 0
+PROCFS_FULL_SCAN_EVERY = 10
+
+
+def collect_connections_procfs(
+    tcp_connections: dict[int, set[int]], udp_connections: dict[int, set[int]]
+) -> None:
+    """Linux only: the listening sockets, resolved to pids through /proc."""
+    global _socket_owners, _socket_owners_reused
+
+    inodes = read_listening_inodes()
+    if not inodes:
+        return
+
+    if (
+        inodes.keys() <= _socket_owners.keys()
+        and _socket_owners_reused < PROCFS_FULL_SCAN_EVERY
+    ):
+        _socket_owners_reused += 1
+    else:
+        _socket_owners = find_socket_owners(inodes)
+        _socket_owners_reused = 0
+
+    for inode, (proto, port) in inodes.items():
+        pid = _socket_owners.get(inode)
+        if pid is None:
+            continue
+        container = tcp_connections if proto == "tcp" else udp_connections
+        container.setdefault(pid, set()).add(port)
+
+
+# Columns of `lsof -nP` we need: PID (2nd), NODE (8th, the protocol) and
+# NAME (9th, the address).
+LSOF_LINE_RE = re.compile(r"^\S+\s+(\d+)\s+\S+\s+\S+\s+\S+\s+\S+\s+\S+\s+(\S+)\s+(\S+)")
+
+
+def collect_connections_psutil(
+    tcp_connections: dict[int, set[int]],
+    udp_connections: dict[int, set[int]],
+    sudo_password: str | None = None,
+) -> None:
+    # psutil needs no sudo here, or already runs with enough privileges
+    for c in psutil.net_connections(kind="inet"):
+        # the pid is None for sockets of processes we may not inspect
+        if c.status == "LISTEN" and c.pid is not None:
+            if c.type == socket.SOCK_STREAM:
+                container = tcp_connections.setdefault(c.pid, set())
+                container.add(c.laddr[1])
+            elif c.type == socket.SOCK_DGRAM:
+                container = udp_connections.setdefault(c.pid, set())
+                container.add(c.laddr[1])
+
+
+def collect_connections_lsof(
+    tcp_connections: dict[int, set[int]],
+    udp_connections: dict[int, set[int]],
+    sudo_password: str | None = None,
+) -> None:
+    # Fallback using 'lsof' (Unix only)
+    try:
+        args = []
+        if sudo_password:
+            args = ["sudo", "-S"]
+        args += [
+            "lsof",
+            "-nP",
+            "-iTCP",
+            "-iUDP",
+        ]
+        try:
+            if sudo_password is not None:
+                LOGGER.debug("Running lsof with sudo")
+                output = subprocess.check_output(
+                    args,
+                    text=True,
+                    input=sudo_password + "\n",
+                    stderr=subprocess.PIPE,
+                )
+            else:
+                LOGGER.debug("Running lsof without sudo")
+                output = subprocess.check_output(
+                    args, text=True, stderr=subprocess.PIPE
+                )
+        except subprocess.CalledProcessError as e:
+            LOGGER.error("Failed to run lsof command: %s", e)
+            LOGGER.error("stdout: %s", e.output)
+            LOGGER.error("stderr: %s", e.stderr)
+            raise
+        for line in output.splitlines()[1:]:
+            match = LSOF_LINE_RE.match(line)
+            if match is None:
+                continue
+            pid_str, proto, port_info = match.groups()
+            if ":" not in port_info:
+                continue
+            port_str = port_info.rsplit(":", 1)[-1]
+            if not port_str.isdigit():
+                continue
+            pid = int(pid_str)
+            port = int(port_str)
+            if proto.startswith("TCP") and "LISTEN" in line:
+                container = tcp_connections.setdefault(pid, set())
+                container.add(port)
+            elif proto.startswith("UDP"):
+                container = udp_connections.setdefault(pid, set())
+                container.add(port)
+    except Exception as e:
+        LOGGER.error("exception: %s", e)
+        raise e
+
+
+if HAS_PSUTIL:
+    _collect_connections = collect_connections_psutil
+    _process_row = _process_row_psutil
+else:
+    _collect_connections = collect_connections_lsof
+    _process_row = _process_row_ps
+
+
 def get_connections(
     sudo_password: str | None = None,
-) -> tuple[dict[int, list[int]], dict[int, list[int]]]:
+) -> tuple[dict[int, tuple[int, ...]], dict[int, tuple[int, ...]]]:
     """
     Get a mapping of process IDs to listening ports for both TCP and UDP.
     If needs_sudo is True and sudo_password is provided, use sudo -S and pass the password via stdin.
@@ -127,77 +529,62 @@ def get_connections(
     tcp_connections: dict[int, set[int]] = {}
     udp_connections: dict[int, set[int]] = {}
 
-    def mapper(connections: dict[int, set[int]]) -> dict[int, list[int]]:
-        return {k: list(v) for k, v in connections.items()}
-
-    if HAS_PSUTIL:
-        for c in psutil.net_connections():
-            if c.status == "LISTEN":
-                if c.type == socket.SOCK_STREAM:
-                    container = tcp_connections.setdefault(c.pid, set())
-                    container.add(c.laddr[1])
-                elif c.type == socket.SOCK_DGRAM:
-                    container = udp_connections.setdefault(c.pid, set())
-                    container.add(c.laddr[1])
-        return mapper(tcp_connections), mapper(udp_connections)
-    else:
-        # Fallback using 'lsof' (Unix only)
-        try:
-            args = []
-            if sudo_password:
-                args = ["sudo", "-S"]
-            args += [
-                "lsof",
-                "-nP",
-                "-iTCP",
-                "-iUDP",
-            ]
-            try:
-                if sudo_password is not None:
-                    LOGGER.debug("Running lsof with sudo")
-                    output = subprocess.check_output(
-                        args,
-                        text=True,
-                        input=sudo_password + "\n",
-                        stderr=subprocess.PIPE,
-                    )
-                else:
-                    LOGGER.debug("Running lsof without sudo")
-                    output = subprocess.check_output(
-                        args, text=True, stderr=subprocess.PIPE
-                    )
-            except subprocess.CalledProcessError as e:
-                LOGGER.error("Failed to run lsof command: %s", e)
-                LOGGER.error("stdout: %s", e.output)
-                LOGGER.error("stderr: %s", e.stderr)
-                raise
-            for line in output.splitlines()[1:]:
-                parts = line.split()
-                if len(parts) < 9:
-                    continue
-                pid = int(parts[1])
-                port_info = parts[8]
-                if ":" not in port_info:
-                    continue
-                port_str = port_info.rsplit(":", 1)[-1]
-                if not port_str.isdigit():
-                    continue
-                port = int(port_str)
-                proto = parts[7]
-                if proto.startswith("TCP") and "LISTEN" in line:
-                    container = tcp_connections.setdefault(pid, set())
-                    container.add(port)
-                elif proto.startswith("UDP"):
-                    container = udp_connections.setdefault(pid, set())
-                    container.add(port)
-        except Exception as e:
-            LOGGER.error(f"exception: {e}")
-            raise e
+    def mapper(connections: dict[int, set[int]]) -> dict[int, tuple[int, ...]]:
+        # sort once here so that consumers can use the lists as they are
+        return {k: tuple(sorted(v)) for k, v in connections.items()}
 
+    if IS_LINUX and not sudo_password:
+        collect_connections_procfs(tcp_connections, udp_connections)
+    else:
+        _collect_connections(tcp_connections, udp_connections, sudo_password)
     return mapper(tcp_connections), mapper(udp_connections)
 
 
-if __name__ == "__main__":
+# (connections, processes) of the last get_listening_processes() call
+_last_listening: tuple[tuple[dict, dict], dict[int, Process]] | None = None
+_listening_reused = 0
+LISTENING_REFRESH_EVERY = 5
+
+
+def get_listening_processes(sudo_password: str | None = None) -> dict[int, Process]:
+    """
+    Processes that listen on at least one TCP/UDP port.
+
+    Sockets are gathered with a single system-wide scan and per-process
+    details are then only looked up for the listening pids. Iterating
+    `psutil.process_iter(["connections"])` instead would re-read the socket
+    tables once per process on Linux.
+    """
+    global _last_listening, _listening_reused
+
+    connections = get_connections(sudo_password)
+    # Same sockets owned by the same pids: the processes are most likely the
+    # same too, only their status may change, which a refresh every
+    # LISTENING_REFRESH_EVERY calls still picks up
+    if (
+        _last_listening is not None
+        and _last_listening[0] == connections
+        and _listening_reused < LISTENING_REFRESH_EVERY
+    ):
+        _listening_reused += 1
+        return _last_listening[1]
+
+    processes = get_processes(*connections)
+    _listening_reused = 0
+    if _last_listening is not None:
+        last_processes = _last_listening[1]
+        # unchanged processes are the very same objects as before; hand out
+        # the previous dict then, so that callers can tell by identity
+        if processes.keys() == last_processes.keys() and all(
+            process is last_processes[pid] for pid, process in processes.items()
+        ):
+            processes = last_processes
+    _last_listening = (connections, processes)
+    return processes
+
+
+# not when bundled into the remote script, where it would only delay startup
+if __name__ == "__main__" and not locals().get("ssh_single_file_mode", False):
     connections, udp_connections = get_connections()
     print("tcp connections", connections)
     print("udp connections", udp_connections)
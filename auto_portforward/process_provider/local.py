@@ -3,21 +3,19 @@ from . import abstract_provider
 from . import get_process_with_openports
 
 
-class MockProcessMonitor(abstract_provider.AbstractProvider):
+class MockProcessMonitor(abstract_provider.BaseProvider):
     def __init__(self):
         super().__init__()
-        self.processes: dict[int, datatype.Process] = {}
-
-    async def get_processes(self) -> dict[str, datatype.Process]:
-        # Create some mock processes with listening ports
-        mock_processes = {
+        # Some mock processes with listening ports. They never change, so the
+        # same snapshot is returned on every poll.
+        self.processes: dict[str, datatype.Process] = {
             "1234": datatype.Process(
                 pid=1234,
                 name="nginx",
                 cwd="/etc/nginx",
                 status="running",
                 create_time="1234567890",
-                tcp=[80, 443],
+                tcp=(80, 443),
             ),
             "5678": datatype.Process(
                 pid=5678,
@@ -25,7 +23,7 @@ class MockProcessMonitor(abstract_provider.AbstractProvider):
                 cwd="/home/user/code",
                 status="running",
                 create_time="1234567891",
-                tcp=[8000],
+                tcp=(8000,),
             ),
             "5679": datatype.Process(
                 pid=5679,
@@ -33,7 +31,7 @@ class MockProcessMonitor(abstract_provider.AbstractProvider):
                 cwd="/home/user/code",
                 status="running",
                 create_time="1234567893",
-                tcp=[8005],
+                tcp=(8005,),
             ),
             "9012": datatype.Process(
                 pid=9012,
@@ -41,7 +39,7 @@ class MockProcessMonitor(abstract_provider.AbstractProvider):
                 cwd="/var/lib/postgresql",
                 status="running",
                 create_time="1234567892",
-                tcp=[5432],
+                tcp=(5432,),
             ),
             "9013": datatype.Process(
                 pid=9013,
@@ -49,22 +47,26 @@ class MockProcessMonitor(abstract_provider.AbstractProvider):
                 cwd="/etc/bind",
                 status="running",
                 create_time="1234567893",
-                tcp=[],
-                udp=[53],
+                tcp=(),
+                udp=(53,),
             ),
         }
-        return mock_processes
+
+    async def get_processes(self) -> dict[str, datatype.Process]:
+        return self.processes
 
 
-class LocalProcessMonitor(abstract_provider.AbstractProvider):
+class LocalProcessMonitor(abstract_provider.BaseProvider):
     def __init__(self):
         super().__init__()
         self.processes: dict[int, datatype.Process] = {}
+        self.str_keyed_processes: dict[str, datatype.Process] = {}
 
     async def get_processes(self) -> dict[str, datatype.Process]:
-        connections, udp_connections = get_process_with_openports.get_connections()
-        processes = get_process_with_openports.get_processes(
-            connections, udp_connections
-        )
-        self.processes = processes
-        return {str(k): v for k, v in self.processes.items()}
+        processes = get_process_with_openports.get_listening_processes()
+        # the same dict is returned while nothing changed
+        if processes is not self.processes:
+            self.processes = processes
+            self.str_keyed_processes = {str(k): v for k, v in processes.items()}
+            self.mark_changed()
+        return self.str_keyed_processes
@@ -6,18 +6,217 @@ It is used to monitor processes on a remote machine.
 To be run on the remote machine.
 """
 
-import socket
+import asyncio
 import json
-import time
+import os
+import signal
+import socket
+import struct
 import sys
 
-from dataclasses import asdict
-
 # if we are in ssh_single_file_mode
-# we directly inject the get_connections and get_processes functions
-# into the local namespace
+# we directly inject the get_listening_processes
+# function into the local namespace
 if not locals().get("ssh_single_file_mode", False):
-    from .get_process_with_openports import get_connections, get_processes
+    from .get_process_with_openports import get_listening_processes
+
+
+def encode_process(process) -> dict:
+    """
+    `default` hook for json.dumps, for when this runs as a module and gets
+    Process dataclasses (the single-file script produces plain dicts). Unlike
+    asdict(), this does not deep-copy every field just so that json can walk
+    it again.
+    """
+    return {name: getattr(process, name) for name in process.__dataclass_fields__}
+
+
+# orjson is used when the remote happens to have it; it encodes dataclasses
+# natively and returns bytes, skipping the str round trip of json.dumps
+try:
+    import orjson
+
+    def dump_message(data: dict) -> bytes:
+        return orjson.dumps(data, default=encode_process)
+
+except ImportError:
+
+    def dump_message(data: dict) -> bytes:
+        return json.dumps(data, default=encode_process).encode()
+
+
+# Every message is prefixed with its length as a 4-byte big-endian integer
+FRAME_HEADER = struct.Struct(">I")
+
+# Seconds between two snapshots
+INTERVAL = 1.5
+
+# Sent when there was nothing else to send for HEARTBEAT_INTERVAL seconds
+HEARTBEAT = {"type": "heartbeat"}
+HEARTBEAT_INTERVAL = 5
+
+# Sent by the controller to have a snapshot taken right away
+REFRESH_REQUEST = b"r"
+
+# How often, and after how long at first, to retry a broken connection
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.5
+
+
+async def produce_snapshots(queue: asyncio.Queue, refresh: asyncio.Event) -> None:
+    """
+    Collect snapshots in a worker thread (psutil/lsof calls are blocking) while
+    the previous snapshot may still be on the wire. When the network stalls,
+    the oldest queued snapshot is dropped: the next delta is computed against
+    what was last sent, so only the freshest snapshot matters. A snapshot is
+    taken every INTERVAL, or as soon as `refresh` is set.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        # cleared first, so that a request made during collection is honoured
+        refresh.clear()
+        processes = await loop.run_in_executor(None, get_listening_processes)
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(processes)
+        try:
+            await asyncio.wait_for(refresh.wait(), INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def diff_snapshots(previous: dict, processes: dict) -> dict | None:
+    """The delta message between two snapshots, or None if nothing changed."""
+    added = {}
+    changed = {}
+    for pid, process in processes.items():
+        if pid not in previous:
+            added[pid] = process
+        # unchanged processes are usually the very same object as before
+        elif previous[pid] is not process and previous[pid] != process:
+            changed[pid] = process
+    removed = [pid for pid in previous if pid not in processes]
+    if not (added or changed or removed):
+        return None
+    return {
+        "type": "delta",
+        "added": added,
+        "changed": changed,
+        "removed": removed,
+    }
+
+
+async def send_snapshots(queue: asyncio.Queue, writer: asyncio.StreamWriter) -> None:
+    """
+    The first message is a full snapshot; after that only the processes that
+    were added, changed or removed are sent. When the host is idle only a
+    heartbeat is sent every HEARTBEAT_INTERVAL, so that the controller can
+    tell an idle host from a dead connection.
+    """
+    loop = asyncio.get_running_loop()
+    previous: dict | None = None
+    last_sent = loop.time()
+    while True:
+        timeout = max(last_sent + HEARTBEAT_INTERVAL - loop.time(), 0)
+        try:
+            snapshot = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            data = HEARTBEAT
+        else:
+            processes = {str(k): v for k, v in snapshot.items()}
+            if previous is None:
+                data = {"type": "snapshot", "processes": processes}
+            else:
+                data = diff_snapshots(previous, processes)
+            previous = processes
+            if data is None:
+                continue
+
+        msg = dump_message(data)
+        # header and payload are handed over separately instead of being
+        # concatenated into a third copy; the transport sends both with a
+        # single sendmsg() and keeps whatever the kernel did not take yet
+        writer.writelines((FRAME_HEADER.pack(len(msg)), msg))
+        await writer.drain()
+        last_sent = loop.time()
+
+
+async def wait_for_controller(
+    reader: asyncio.StreamReader, refresh: asyncio.Event
+) -> None:
+    # The controller only sends refresh requests; EOF means it closed its end.
+    while data := await reader.read(1024):
+        if REFRESH_REQUEST in data:
+            refresh.set()
+    print("Controller closed the connection")
+
+
+def tune_socket(sock) -> None:
+    """
+    Send the small frames right away instead of waiting for Nagle, and use
+    keep-alive probes so a dead tunnel is noticed.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if sys.platform.startswith("linux"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
+async def run_session(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Serve one connection; returns once the controller closes it."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+    refresh = asyncio.Event()
+    tasks = [
+        asyncio.create_task(produce_snapshots(queue, refresh)),
+        asyncio.create_task(send_snapshots(queue, writer)),
+        asyncio.create_task(wait_for_controller(reader, refresh)),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # re-raise any error from the task that stopped first
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        print("Closing connection")
+        writer.close()
+
+
+async def run_sender(address) -> None:
+    """
+    Keep a connection to the controller, at a TCP port on localhost or at a
+    unix socket path. When it breaks, reconnect with an exponential backoff
+    rather than exiting, so the ssh session is kept.
+    """
+    attempt = 0
+    while True:
+        print(f"Connecting to local socket {address}")
+        try:
+            if isinstance(address, int):
+                reader, writer = await asyncio.open_connection("localhost", address)
+                tune_socket(writer.get_extra_info("socket"))
+            else:
+                reader, writer = await asyncio.open_unix_connection(address)
+            print("Connected to local socket")
+            attempt = 0
+            await run_session(reader, writer)
+            return
+        except FileNotFoundError:
+            # sshd did not create the forwarded unix socket; exit right away
+            # so that the controller can fall back to TCP
+            raise
+        except OSError as e:
+            attempt += 1
+            if attempt > RECONNECT_ATTEMPTS:
+                raise
+            delay = RECONNECT_DELAY * 2 ** (attempt - 1)
+            print(f"Connection lost ({e}), reconnecting in {delay}s", file=sys.stderr)
+            await asyncio.sleep(delay)
 
 
 def send_via_socket():
@@ -28,40 +227,27 @@ def send_via_socket():
     To be run on the remote machine.
     """
     if len(sys.argv) != 2:
-        print("Usage: python3 remote_monitor.py <port>")
+        print("Usage: python3 remote_monitor.py <port|socket path>")
         sys.exit(1)
 
-    port = int(sys.argv[1])
-    print(f"Connecting to local socket on port {port}")
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect(("localhost", port))
-    print("Connected to local socket")
+    address = int(sys.argv[1]) if sys.argv[1].isdigit() else sys.argv[1]
+    # exit through the finally clause below when ssh goes away or stops us
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(run_sender(address))
+    except Exception as e:
+        import traceback
 
-    while True:
-        try:
-            # Send process and connection information
-            connections, udp_connections = get_connections()
-            data = {
-                "type": "data",
-                "processes": {
-                    str(k): asdict(v)
-                    for k, v in get_processes(connections, udp_connections).items()
-                },
-            }
-            msg = json.dumps(data).encode()
-            length_bytes = len(msg).to_bytes(4, "big")
-            print(f"Sending data message, length: {len(msg)}")
-            s.sendall(length_bytes + msg)
-            time.sleep(1.5)  # Update every second
-        except Exception as e:
-            import traceback
-
-            print(f"Error in main loop: {e}", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
-            break
-
-    print("Closing connection")
-    s.close()
+        print(f"Error in main loop: {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        # sshd leaves the forwarded unix socket behind
+        if isinstance(address, str):
+            try:
+                os.unlink(address)
+            except OSError:
+                pass
 
 
 if __name__ == "__main__":
@@ -1,217 +1,297 @@
-import json
+import asyncio
+import base64
+import contextlib
+import hashlib
 import logging
 import os
+import secrets
 import socket
 import subprocess
-import threading
-import signal
+import sys
+import time
+import zlib
 
 from pathlib import Path
-from dataclasses import dataclass, field
+from functools import lru_cache
+
+# orjson parses the frames straight from bytes; json.loads accepts bytes too
+try:
+    from orjson import loads as json_loads, JSONDecodeError
+except ImportError:
+    from json import loads as json_loads, JSONDecodeError
 
 from auto_portforward.ssh_port_forward import SSHForward
-from auto_portforward.utils import preexec_set_pdeathsig
-from .abstract_provider import AbstractProvider
+from auto_portforward.utils import (
+    PIPE_LOGGER,
+    SSH_CONTROL_DIR,
+    close_ssh_control_master,
+    popen_in_own_group,
+    ssh_control_options,
+    terminate_process_group,
+    terminate_process_group_async,
+)
+from .abstract_provider import BaseProvider
 from . import get_process_with_openports, script_on_remote_machine
-from .. import ROOT_DIR, datatype
+from .. import datatype
 
 THIS_DIR = Path(__file__).parent
 
 LOGGER = logging.getLogger(__name__)
 
-
-def build_ssh_single_file_mode_script():
-    remote_script = 'locals()["ssh_single_file_mode"] = True\n'
-    with open(ROOT_DIR / datatype.__file__, "r") as f:
-        remote_script += f.read() + "\n"
-    with open(THIS_DIR / get_process_with_openports.__file__, "r") as f:
-        remote_script += f.read() + "\n"
-    with open(THIS_DIR / script_on_remote_machine.__file__, "r") as f:
-        remote_script += f.read() + "\n"
-
-    return remote_script
-
-
-@dataclass
-class SharedMemory:
-    processes: dict[str, datatype.Process]
-    lock: threading.Lock = field(default_factory=threading.Lock)
-    has_new_data: threading.Event = field(default_factory=threading.Event)
-    is_finished: threading.Event = field(default_factory=threading.Event)
-
-
-def run_remote_script(
-    ssh_host: str, shared_memory: SharedMemory, monitor_instance: "RemoteProcessMonitor"
-):
-    import time
-
-    # time.sleep(2)
+# The remote sends at least a heartbeat every 5 seconds; after this many
+# seconds without any message the connection is considered dead
+DEAD_PEER_TIMEOUT = 15
+
+# Seconds to wait for the remote script to connect (back) to us
+MAX_WAIT_TIME = 30
+
+# Same framing as the remote script: a 4-byte big-endian length per message
+FRAME_HEADER = script_on_remote_machine.FRAME_HEADER
+
+# Where the single-file script is cached on the remote, relative to $HOME
+REMOTE_CACHE_DIR = ".cache/auto-portforward"
+
+
+@lru_cache(maxsize=1)
+def build_ssh_single_file_mode_script() -> str:
+    # the sources do not change while we run, so they are read only once
+    parts = ['locals()["ssh_single_file_mode"] = True\n']
+    for path in (
+        THIS_DIR / get_process_with_openports.__file__,
+        THIS_DIR / script_on_remote_machine.__file__,
+    ):
+        with open(path, "r") as f:
+            parts.append(f.read())
+        parts.append("\n")
+    return "".join(parts)
+
+
+@lru_cache(maxsize=1)
+def build_ssh_bootstrap_script() -> str:
+    """
+    A short program that inflates and runs the single-file script. Compressed,
+    the script takes a fraction of the room on the ssh command line, and the
+    base64 text cannot clash with the shell quoting.
+    """
+    script = build_ssh_single_file_mode_script().encode()
+    payload = base64.b64encode(zlib.compress(script, 9)).decode()
+    return f'import base64,zlib;exec(zlib.decompress(base64.b64decode("{payload}")))'
+
+
+def install_remote_script(ssh_host: str) -> str | None:
+    """
+    Make sure the single-file script is cached on the remote, named after its
+    hash so that a changed script never clashes with an old copy. Returns its
+    path, or None if it could not be installed. The script is only sent over
+    when the remote does not have this version yet.
+    """
+    script = build_ssh_single_file_mode_script().encode()
+    digest = hashlib.sha256(script).hexdigest()[:16]
+    path = f"{REMOTE_CACHE_DIR}/{digest}.py"
+    ssh = ["ssh", *ssh_control_options(), ssh_host]
     try:
-        # Create a local socket for communication
-        LOGGER.debug("Creating local socket")
-        local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        local_socket.bind(("localhost", 0))  # Bind to localhost
-        local_socket.listen(1)
-        port = local_socket.getsockname()[1]
-        LOGGER.debug("Created local socket on port %d", port)
-
-        # Read the remote script
-        LOGGER.debug("Reading remote script from: %s", THIS_DIR)
-
-        # Start the remote Python process that will connect back to us
-        remote_cmd = f"python3 -c '{build_ssh_single_file_mode_script()}' {port}"
-        LOGGER.debug("Starting SSH process with port forwarding")
-        ssh_process = subprocess.Popen(
+        probe = subprocess.run(
+            [*ssh, f"test -f {path}"],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=MAX_WAIT_TIME,
+            check=False,
+        )
+        if probe.returncode == 0:
+            return path
+        if probe.returncode != 1:
+            LOGGER.debug("Probing the remote script failed: %r", probe.stderr)
+            return None
+        LOGGER.debug("Installing the remote script as %s", path)
+        # written under a temporary name, so a partial upload is never run
+        upload = subprocess.run(
             [
-                "ssh",
-                "-R",
-                f"{port}:localhost:{port}",
-                ssh_host,
-                f"AP_SUDO_PASSWORD={os.getenv('AP_SUDO_PASSWORD', '')} {remote_cmd}",
+                *ssh,
+                f"mkdir -p {REMOTE_CACHE_DIR} && cat > {path}.$$ && mv {path}.$$ {path}",
             ],
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True,
-            preexec_fn=preexec_set_pdeathsig,
-            start_new_session=True,
+            input=script,
+            capture_output=True,
+            timeout=MAX_WAIT_TIME,
+            check=False,
         )
+    except (OSError, subprocess.SubprocessError) as e:
+        LOGGER.debug("Installing the remote script failed: %s", e)
+        return None
+    if upload.returncode != 0:
+        LOGGER.debug("Installing the remote script failed: %r", upload.stderr)
+        return None
+    return path
+
+
+def process_from_dict(proc: dict) -> datatype.Process:
+    return datatype.Process(
+        pid=proc["pid"],
+        # the same few values come in again and again; interned, the copies
+        # from every message are dropped and comparisons are by identity
+        name=sys.intern(proc["name"]),
+        cwd=sys.intern(proc["cwd"]),
+        status=sys.intern(proc["status"]),
+        create_time=proc["create_time"],
+        # the remote already sends the ports sorted
+        tcp=tuple(proc["tcp"]),
+        udp=tuple(proc["udp"]),
+    )
+
+
+def apply_message(
+    info: dict, last_data: dict[str, datatype.Process]
+) -> dict[str, datatype.Process] | None:
+    """
+    The processes after a snapshot or delta message, as a new dict (one that
+    has been handed out is never mutated), or None if nothing changed.
+    """
+    if info["type"] == "snapshot":
+        # e.g. after a reconnect: keep the objects we already have for
+        # processes that did not change meanwhile
+        new_data = {}
+        for pid, proc in info["processes"].items():
+            process = process_from_dict(proc)
+            old = last_data.get(pid)
+            new_data[pid] = old if old == process else process
+        return new_data if new_data != last_data else None
+
+    # deltas are only sent when something changed
+    new_data = dict(last_data)
+    for pid in info["removed"]:
+        new_data.pop(pid, None)
+    for pid, proc in info["added"].items():
+        new_data[pid] = process_from_dict(proc)
+    for pid, proc in info["changed"].items():
+        new_data[pid] = process_from_dict(proc)
+    return new_data
+
+
+def start_remote_script(
+    ssh_host: str, local: int | str, remote: int | str
+) -> subprocess.Popen:
+    """
+    Start the remote script, which connects back to `local` through ssh -R.
+    Both ends are either the same TCP port on localhost, or unix socket paths
+    (`remote` being the path the script connects to on the remote host).
+    """
+    script_path = install_remote_script(ssh_host)
+    if script_path is not None:
+        remote_cmd = f"python3 {script_path} {remote}"
+    else:
+        # e.g. no writable home on the remote: ship the script inline
+        remote_cmd = f"python3 -c '{build_ssh_bootstrap_script()}' {remote}"
+    if isinstance(local, int):
+        forward = f"{remote}:localhost:{local}"
+    else:
+        forward = f"{remote}:{local}"
+    LOGGER.debug("Starting SSH process with port forwarding")
+    ssh_process = popen_in_own_group(
+        [
+            "ssh",
+            *ssh_control_options(),
+            # fail right away (and fall back) when the forward is refused
+            "-o",
+            "ExitOnForwardFailure=yes",
+            "-R",
+            forward,
+            ssh_host,
+            f"AP_SUDO_PASSWORD={os.getenv('AP_SUDO_PASSWORD', '')} {remote_cmd}",
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # the pipes are read straight from their fds, so no buffering
+        bufsize=0,
+        start_new_session=True,
+    )
+
+    # Log the output of the remote script and of ssh itself
+    PIPE_LOGGER.add(ssh_process.stdout, LOGGER, logging.INFO, "SSH stdout: ")
+    PIPE_LOGGER.add(ssh_process.stderr, LOGGER, logging.ERROR, "SSH stderr: ")
+    return ssh_process
+
+
+def tune_connection(conn: socket.socket) -> None:
+    if conn.family != socket.AF_UNIX:
+        # the remote side sets it too; messages are small and latency bound
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def accept_remote_connection(
+    local_socket: socket.socket,
+    ssh_process: subprocess.Popen,
+    max_wait: float = MAX_WAIT_TIME,
+) -> socket.socket:
+    """Accept the connection from the remote process with timeout"""
+    LOGGER.debug("Waiting for remote connection")
+
+    local_socket.settimeout(2)
+    start_time = time.time()
+    while True:
+        # Check if SSH process is still alive
+        if ssh_process.poll() is not None:
+            exit_code = ssh_process.poll()
+            raise RuntimeError(
+                f"SSH process died with exit code {exit_code} while waiting for connection"
+            )
+
+        if time.time() - start_time > max_wait:
+            raise RuntimeError("Timeout while waiting for remote connection")
+        try:
+            conn, _ = local_socket.accept()
+            LOGGER.debug("Remote connection established")
+            tune_connection(conn)
+            return conn
+        except socket.timeout:
+            LOGGER.debug("Still waiting for remote connection...")
+
+
+async def accept_remote_connection_async(
+    local_socket: socket.socket,
+    ssh_process: subprocess.Popen,
+    max_wait: float = MAX_WAIT_TIME,
+) -> socket.socket:
+    """accept_remote_connection() without blocking the event loop"""
+    LOGGER.debug("Waiting for remote connection")
+
+    loop = asyncio.get_running_loop()
+    local_socket.setblocking(False)
+    deadline = loop.time() + max_wait
+    while True:
+        if ssh_process.poll() is not None:
+            raise RuntimeError(
+                f"SSH process died with exit code {ssh_process.poll()} while waiting for connection"
+            )
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise RuntimeError("Timeout while waiting for remote connection")
+        try:
+            conn, _ = await asyncio.wait_for(
+                loop.sock_accept(local_socket), min(2, remaining)
+            )
+            LOGGER.debug("Remote connection established")
+            tune_connection(conn)
+            return conn
+        except TimeoutError:
+            LOGGER.debug("Still waiting for remote connection...")
 
-        # Start threads to monitor stdout/stderr
-        def log_output(pipe, prefix):
-            for line in pipe:
-                if prefix == "stderr":
-                    LOGGER.error(f"SSH {prefix}: {line.strip()}")
-                else:
-                    LOGGER.info(f"SSH {prefix}: {line.strip()}")
-
-        threading.Thread(
-            target=log_output, args=(ssh_process.stdout, "stdout"), daemon=True
-        ).start()
-        threading.Thread(
-            target=log_output, args=(ssh_process.stderr, "stderr"), daemon=True
-        ).start()
-
-        # Accept the connection from the remote process with timeout
-        LOGGER.debug("Waiting for remote connection")
-
-        MAX_WAIT_TIME = 30
-        local_socket.settimeout(2)
-        start_time = time.time()
-        while True:
-            # Check if SSH process is still alive
-            if ssh_process.poll() is not None:
-                exit_code = ssh_process.poll()
-                raise RuntimeError(
-                    f"SSH process died with exit code {exit_code} while waiting for connection"
-                )
-
-            if time.time() - start_time > MAX_WAIT_TIME:
-                raise RuntimeError("Timeout while waiting for remote connection")
-            try:
-                conn, _ = local_socket.accept()
-                LOGGER.debug("Remote connection established")
-                break
-            except socket.timeout:
-                LOGGER.debug("Still waiting for remote connection...")
-                continue
-
-        # Store the connection in the monitor instance, so that we can close it when cleanup is called
-        monitor_instance.conn = conn
-        monitor_instance.ssh_process = ssh_process
-    except Exception as e:
-        LOGGER.error(f"Error in setup_connection: {e}", exc_info=True)
-        raise
-
-    conn.settimeout(3)
-
-    try:
-        last_data: dict[str, datatype.Process] = {}
-        while not shared_memory.is_finished.is_set():
-            # Read message length (4 bytes)
-            try:
-                # LOGGER.debug("Reading message length")
-                length_bytes = conn.recv(4)
-            except socket.timeout:
-                continue
-
-            # LOGGER.debug("Received message length: %s", length_bytes)
-            if not length_bytes:
-                raise RuntimeError("Connection closed by remote")
-
-            length = int.from_bytes(length_bytes, "big")
-            # LOGGER.debug("Received message length: %d", length)
-
-            # Read the full message
-            data = conn.recv(length)
-
-            try:
-                info = json.loads(data.decode())
-                if info.get("type") == "log":
-                    # Handle log message
-                    LOGGER.info("Remote: %s", info["message"])
-                elif info.get("type") == "data":
-                    # Handle process data
-                    new_data = {
-                        pid: datatype.Process(
-                            pid=proc["pid"],
-                            name=proc["name"],
-                            cwd=proc["cwd"],
-                            status=proc["status"],
-                            create_time=proc["create_time"],
-                            tcp=sorted(proc["tcp"]),
-                            udp=sorted(proc["udp"]),
-                        )
-                        for pid, proc in info["processes"].items()
-                    }
-                    if new_data != last_data:
-                        with shared_memory.lock:
-                            LOGGER.debug("Setting new data")
-                            shared_memory.processes = new_data
-                            shared_memory.has_new_data.set()
-                        last_data = new_data
-
-            except json.JSONDecodeError as e:
-                LOGGER.error("Error decoding JSON: %s", e)
-                LOGGER.debug("Problematic data: %s", data)
-    except socket.error as e:
-        # socket is closing
-        LOGGER.debug("Socket error in run_remote_script: %s", e)
-        pass
-    except Exception as e:
-        LOGGER.debug("Exception in run_remote_script: %s", e, exc_info=True)
-    finally:
-        LOGGER.debug("Terminating SSH process")
-        ssh_process.send_signal(signal.SIGINT)
-        ssh_process.terminate()
-        # os.killpg(os.getpgid(ssh_process.pid), signal.SIGTERM)
 
-        try:
-            ssh_process.wait(timeout=0.5)
-        except subprocess.TimeoutExpired:
-            LOGGER.warning("SSH process did not terminate gracefully, killing...")
-            ssh_process.kill()
-            ssh_process.wait()
-        # LOGGER.debug("Closing local socket")
-        # conn.close()
-        # local_socket.close()
-        # for thread in threads:
-        #     thread.cancel()
-        #     thread.join()
-    LOGGER.debug("Remote socket script finished")
-
-
-class RemoteProcessMonitor(AbstractProvider):
+class RemoteProcessMonitor(BaseProvider):
     def __init__(self, ssh_host: str):
         super().__init__()
         self.ssh_host = ssh_host
         LOGGER.debug("Initializing RemoteProcessMonitor for host: %s", ssh_host)
-        self.shared_memory = SharedMemory(processes={})
-        self.thread: threading.Thread | None = None
-        self.cached_processes: dict[str, datatype.Process] = {}
+        # Replaced as a whole on every update and never mutated after that
+        self.processes: dict[str, datatype.Process] = {}
+        self.local_socket: socket.socket | None = None
+        self.local_socket_path: Path | None = None
         self.conn: socket.socket | None = None  # Store the socket connection
         self.ssh_process: subprocess.Popen | None = None
+        # task applying the messages of the remote script
+        self.receiver: asyncio.Task | None = None
+        # writing end of the current connection, for refresh requests
+        self.writer: asyncio.StreamWriter | None = None
         self.forwarded_ports: dict[int, SSHForward] = {}
 
     @property
@@ -228,30 +308,151 @@ class RemoteProcessMonitor(AbstractProvider):
             return False
 
     def setup_connection(self):
-        self.thread = threading.Thread(
-            target=run_remote_script, args=(self.ssh_host, self.shared_memory, self)
+        # The tunnel preferably runs between unix sockets, which skip the TCP
+        # stack and, unlike a port on localhost, only we can connect to. The
+        # sshd may not allow forwarding those, so fall back to TCP.
+        try:
+            self.setup_unix_connection()
+            return
+        except (OSError, RuntimeError) as e:
+            LOGGER.info("Could not tunnel over unix sockets, using TCP: %s", e)
+            self.close_connection()
+
+        # Create a local socket for communication
+        LOGGER.debug("Creating local socket")
+        self.local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.local_socket.bind(("localhost", 0))  # Bind to localhost
+        self.local_socket.listen(1)
+        port = self.local_socket.getsockname()[1]
+        LOGGER.debug("Created local socket on port %d", port)
+
+        self.ssh_process = start_remote_script(self.ssh_host, port, port)
+        self.conn = accept_remote_connection(self.local_socket, self.ssh_process)
+
+    def setup_unix_connection(self):
+        token = secrets.token_hex(8)
+        SSH_CONTROL_DIR.mkdir(parents=True, exist_ok=True)
+        self.local_socket_path = SSH_CONTROL_DIR / f"remote-{token}.sock"
+        self.local_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.local_socket.bind(str(self.local_socket_path))
+        self.local_socket.listen(1)
+        LOGGER.debug("Created local socket at %s", self.local_socket_path)
+
+        self.ssh_process = start_remote_script(
+            self.ssh_host, str(self.local_socket_path), f"/tmp/apf-{token}.sock"
         )
-        self.thread.start()
+        self.conn = accept_remote_connection(self.local_socket, self.ssh_process)
+
+    def close_connection(self):
+        """Undo a failed setup_connection() attempt."""
+        if self.ssh_process:
+            terminate_process_group(self.ssh_process)
+            self.ssh_process = None
+        if self.local_socket:
+            self.local_socket.close()
+            self.local_socket = None
+        if self.local_socket_path:
+            self.local_socket_path.unlink(missing_ok=True)
+            self.local_socket_path = None
 
     async def get_processes(self) -> dict[str, datatype.Process]:
-        if self.shared_memory.has_new_data.is_set():
-            with self.shared_memory.lock:
-                self.cached_processes = self.shared_memory.processes
-            self.shared_memory.has_new_data.clear()
-        return self.cached_processes
+        # connect() runs before the event loop of the UI does, so the receiver
+        # is started by the first poll
+        if self.receiver is None and self.conn is not None:
+            self.receiver = asyncio.create_task(self.receive_messages())
+        return self.processes
+
+    async def receive_messages(self) -> None:
+        try:
+            while True:
+                reader, self.writer = await asyncio.open_connection(sock=self.conn)
+                try:
+                    await self.read_messages(reader)
+                finally:
+                    self.writer.close()
+                    self.writer = None
+                if self.ssh_process is None:
+                    # cleanup() is tearing the connection down
+                    return
+                # the remote reconnects after network errors; give it a chance
+                LOGGER.warning("Connection closed by remote, waiting for reconnect")
+                self.conn = await accept_remote_connection_async(
+                    self.local_socket, self.ssh_process
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.error("Lost the connection to the remote host: %s", e, exc_info=True)
+
+    async def refresh(self) -> None:
+        """Ask the remote for a snapshot now rather than at its next interval."""
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(script_on_remote_machine.REFRESH_REQUEST)
+            await self.writer.drain()
+        except OSError as e:
+            LOGGER.debug("Could not request a refresh: %s", e)
+
+    async def read_messages(self, reader: asyncio.StreamReader) -> None:
+        """Apply the messages of one connection until it closes or goes silent."""
+        while True:
+            try:
+                header = await asyncio.wait_for(
+                    reader.readexactly(FRAME_HEADER.size), DEAD_PEER_TIMEOUT
+                )
+                (length,) = FRAME_HEADER.unpack(header)
+                data = await reader.readexactly(length)
+            except TimeoutError:
+                # not even a heartbeat: the tunnel is most likely gone
+                LOGGER.warning("No message from remote for %ds", DEAD_PEER_TIMEOUT)
+                return
+            except asyncio.IncompleteReadError:
+                return
+
+            try:
+                info = json_loads(data)
+            except JSONDecodeError as e:
+                LOGGER.error("Error decoding JSON: %s", e)
+                # %r of a large frame is costly; only build it when shown
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug("Problematic data: %r", data[:1024])
+                continue
+
+            if info.get("type") == "heartbeat":
+                pass
+            elif info.get("type") == "log":
+                # Handle log message
+                LOGGER.info("Remote: %s", info["message"])
+            elif info.get("type") in ("snapshot", "delta"):
+                new_data = apply_message(info, self.processes)
+                if new_data is not None:
+                    self.processes = new_data
+                    self.mark_changed()
 
     async def cleanup(self) -> None:
-        # try to kill the ssh process to speed up cleanup
+        # stop receiving first: once ssh goes away the receiver would see the
+        # connection close and wait for a reconnect that cannot happen
+        if self.receiver:
+            self.receiver.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.receiver
+            self.receiver = None
+
+        # then stop the ssh process, to speed up the rest of the cleanup
         if self.ssh_process:
-            self.ssh_process.kill()
+            ssh_process, self.ssh_process = self.ssh_process, None
+            # the exit is awaited through a pidfd, without blocking the loop
+            await terminate_process_group_async(ssh_process)
 
         LOGGER.debug("Cleaning up RemoteProcessMonitor")
-        for port in self.forwarded_ports:
-            self.forwarded_ports[port].cleanup()
+        await asyncio.gather(
+            *(forward.stop() for forward in self.forwarded_ports.values()),
+            return_exceptions=True,
+        )
         self.forwarded_ports.clear()
 
-        with self.shared_memory.lock:
-            self.shared_memory.is_finished.set()
+        LOGGER.debug("Closing connection")
         if self.conn:
             try:
                 self.conn.shutdown(socket.SHUT_RDWR)
@@ -260,20 +461,27 @@ class RemoteProcessMonitor(AbstractProvider):
             finally:
                 self.conn.close()
                 self.conn = None
-
-        LOGGER.debug("Closing connection")
-        if self.thread:
-            self.thread.join()
-            self.thread = None
+        if self.local_socket:
+            self.local_socket.close()
+            self.local_socket = None
+        if self.local_socket_path:
+            self.local_socket_path.unlink(missing_ok=True)
+            self.local_socket_path = None
+
+        # the master connection outlives its clients; close it so that no
+        # forwarding requested through it is left behind
+        try:
+            await close_ssh_control_master(self.ssh_host)
+        except OSError as e:  # TimeoutError included
+            LOGGER.debug("Error closing ssh master connection: %s", e)
 
     async def on_ports_turned_on(self, port: int):
         self.forwarded_ports[port] = SSHForward(port, ssh_host=self.ssh_host)
         try:
             # Start the reverse_port subprocess with process group
-            self.forwarded_ports[port].start()
+            await self.forwarded_ports[port].start()
         except Exception as e:
             LOGGER.error("Failed to start port forwarding for port %s: %s", port, e)
 
     async def on_ports_turned_off(self, port: int):
-        self.forwarded_ports[port].cleanup()
-        self.forwarded_ports.pop(port)
+        await self.forwarded_ports.pop(port).stop()
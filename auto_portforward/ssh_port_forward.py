@@ -1,11 +1,16 @@
+import asyncio
 import subprocess
 import logging
 
-import os
-import signal
 import atexit
 
-from auto_portforward.utils import preexec_set_pdeathsig
+from auto_portforward.utils import (
+    PIPE_LOGGER,
+    popen_in_own_group,
+    ssh_control_options,
+    terminate_process_group,
+    terminate_process_group_async,
+)
 
 LOGGER = logging.getLogger(__file__)
 
@@ -18,43 +23,129 @@ class SSHForward:
         self.ssh_host = ssh_host
         # whether the cleanup has been called
         self.had_cleanup = False
-        # the process that is running the port forwarding
+        # the process that is running the port forwarding, if it could not be
+        # added to the ssh master connection of the host
         self.process: subprocess.Popen | None = None
+        # whether the forwarding was added to the ssh master connection
+        self.multiplexed = False
         # register cleanup to be called when the program exits
         atexit.register(self.cleanup)
 
-    def start(self):
-        self.process = subprocess.Popen(
-            ["ssh", "-N", "-L", f"{self.port}:localhost:{self.port}", self.ssh_host],
+    @property
+    def forward_spec(self) -> str:
+        return f"{self.port}:localhost:{self.port}"
+
+    def master_command(self, command: str) -> list[str]:
+        """ssh invocation asking the master connection to `forward`/`cancel` the port"""
+        return [
+            "ssh",
+            *ssh_control_options(),
+            "-O",
+            command,
+            "-L",
+            self.forward_spec,
+            self.ssh_host,
+        ]
+
+    async def request_from_master(self, command: str) -> bool:
+        """
+        Ask the master connection of the host to `forward` or `cancel` the
+        port, without blocking the event loop while ssh talks to it. Returns
+        False if there is no master or it refused.
+        """
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self.master_command(command),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        except OSError as e:
+            LOGGER.debug("ssh -O %s failed for port %s: %s", command, self.port, e)
+            return False
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=5)
+        except TimeoutError:
+            process.kill()
+            await process.wait()
+            LOGGER.debug("ssh -O %s timed out for port %s", command, self.port)
+            return False
+        if process.returncode != 0:
+            LOGGER.debug(
+                "ssh -O %s failed for port %s: %s",
+                command,
+                self.port,
+                stderr.decode(errors="replace").strip(),
+            )
+            return False
+        return True
+
+    async def start(self):
+        # Adding the forwarding to the existing master connection needs no new
+        # TCP connection, key exchange or authentication
+        if await self.request_from_master("forward"):
+            self.multiplexed = True
+            LOGGER.info(
+                "Started port forwarding for port %s through the ssh master connection",
+                self.port,
+            )
+            return
+
+        # only fork/exec happens here; the pipes are read by PIPE_LOGGER
+        self.process = popen_in_own_group(
+            ["ssh", "-N", "-L", self.forward_spec, self.ssh_host],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            preexec_fn=preexec_set_pdeathsig,
+            bufsize=0,
         )
+        PIPE_LOGGER.add(self.process.stdout, LOGGER, logging.DEBUG, "ssh: ")
+        PIPE_LOGGER.add(self.process.stderr, LOGGER, logging.WARNING, "ssh: ")
         LOGGER.info(
             "Started port forwarding for port %s with PID %s",
             self.port,
             self.process.pid,
         )
 
-    def cleanup(self):
+    async def stop(self):
+        """cleanup() for callers on the event loop"""
         if self.had_cleanup:
             return
+        self.had_cleanup = True
         try:
-            self.process.terminate()
-            os.kill(self.process.pid, signal.SIGINT)
-            # # Kill the entire process group
-            os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
-            self.process.wait(timeout=5)
+            if self.multiplexed:
+                await self.request_from_master("cancel")
+            elif self.process is not None:
+                # waits up to 100ms for the process to go away
+                await terminate_process_group_async(self.process)
+            else:
+                return
             LOGGER.info("Terminated port forwarding for port %s", self.port)
-        except subprocess.TimeoutExpired:
-            LOGGER.warning(
-                "Port forwarding process for port %s did not terminate gracefully, forcing...",
-                self.port,
-            )
-            os.kill(self.process.pid, signal.SIGKILL)
-            os.killpg(os.getpgid(self.process.pid), signal.SIGKILL)
         except Exception as e:
             LOGGER.error(
                 "Error terminating port forwarding for port %s: %s", self.port, e
             )
+
+    def cleanup(self):
+        """Blocking variant of stop(), for atexit"""
+        if self.had_cleanup:
+            return
         self.had_cleanup = True
+        try:
+            if self.multiplexed:
+                subprocess.run(
+                    self.master_command("cancel"),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=5,
+                    check=False,
+                )
+            elif self.process is not None:
+                terminate_process_group(self.process)
+            else:
+                return
+            LOGGER.info("Terminated port forwarding for port %s", self.port)
+        except Exception as e:
+            LOGGER.error(
+                "Error terminating port forwarding for port %s: %s", self.port, e
+            )
@@ -1,14 +1,20 @@
 #!/usr/bin/python
 import asyncio
 import logging
-import os
 import threading
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from operator import attrgetter
 from typing import Dict, Set
 from textual import on, work
 from textual.app import App, ComposeResult
 from textual.message_pump import Timer
 from textual.message import Message
-from textual.widgets import Header, Footer, Static, Tree
+from textual.containers import Vertical
+from textual.screen import ModalScreen
+from textual.widgets import Header, Footer, Input, Static, Tree
+from textual.widgets.tree import TreeNode
 from textual.binding import Binding
 from textual.widgets import Log
 
@@ -19,29 +25,155 @@ from rich.text import Text
 
 from auto_portforward.process_provider.abstract_provider import AbstractProvider
 
-from .process_provider.ssh_remote import RemoteProcessMonitor
 from .datatype import Process
 
-# Configure logging
-log_dir = os.path.expanduser("logs")
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "tui.log")
-
 # Create formatters
 FORMATTER = logging.Formatter(
     "[%(asctime)s %(levelname)-5s] %(message)s", datefmt="%H:%M:%S"
 )
 
-# Configure root logger
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
-
 
 LOGGER = logging.getLogger(__file__)
 
 GROUP_SELECTED_STYLE = Style(color="green", italic=True)
 NODE_SELECTED_STYLE = Style(color="yellow", italic=True)
 
+# pids are ints, so processes sort numerically with a C-level key
+PID_OF = attrgetter("pid")
+
+# lowercased process names for the filter; the same few names come up on
+# every layout, so they are only lowercased once
+lowered = lru_cache(maxsize=4096)(str.lower)
+
+
+@lru_cache(maxsize=1024)
+def format_ports(ports: tuple[int, ...]) -> str:
+    """Comma separated ports; the same port tuples come up on every refresh."""
+    return ",".join(map(str, ports))
+
+
+@lru_cache(maxsize=1024)
+def render_process_label(
+    pid: int,
+    name: str,
+    tcp: tuple[int, ...],
+    udp: tuple[int, ...],
+    status: str,
+    style: Style | str,
+) -> Text:
+    """
+    Rich label of a process row. Cached, as most rows are unchanged between
+    refreshes (the tree copies labels before styling them, so sharing is safe).
+    """
+    parts = []
+    if tcp:
+        parts.extend(
+            [
+                (" 🌐", "bold cyan"),
+                ("TCP", "bold cyan u"),
+                (": ", "bold cyan"),
+                format_ports(tcp),
+            ]
+        )
+    if udp:
+        parts.append((" 📡UDP: ", "bold red"))
+        parts.append(format_ports(udp))
+
+    label = Text.assemble(
+        ("🆔", ""),
+        (f"{pid}", "bold"),
+        (" 📦", ""),
+        (f"{name}", "blue"),
+        *parts,
+        (f" (⚡{status})", ""),
+        overflow="ellipsis",
+        justify="center",
+    )
+    label.style = style
+    return label
+
+
+@dataclass(slots=True)
+class GroupPlan:
+    """A group of the tree, as computed by `compute_layout`."""
+
+    key: str
+    style: Style | str
+    # (process, style, label) of each row, in display order
+    rows: list[tuple[Process, Style | str, Text]]
+
+
+def group_processes(
+    processes: Dict[str, Process],
+    group_by: str,
+    sort_reverse: bool,
+    filter_text: str,
+) -> list[tuple[str, list[Process]]]:
+    """Filter `processes` and group them, with both groups and members sorted."""
+    # Group processes
+    grouped: Dict[str, list[Process]] = defaultdict(list)
+    group_key_of = attrgetter(group_by)
+    filter_lower = filter_text.lower()
+    for process in processes.values():
+        if filter_lower and filter_lower not in lowered(process.name):
+            continue
+        # keys are normalised to the displayed string here, so that the groups
+        # sort without a key function
+        group = group_key_of(process)
+        grouped[str(group) if group is not None else "Unknown"].append(process)
+
+    # Sort groups, then processes
+    return [
+        (group_key, sorted(members, key=PID_OF, reverse=sort_reverse))
+        for group_key, members in sorted(grouped.items(), reverse=sort_reverse)
+    ]
+
+
+def compute_layout(
+    grouped: list[tuple[str, list[Process]]],
+    selected_groups: frozenset[str],
+    selected_processes: frozenset[int],
+) -> tuple[list[GroupPlan], Set[int]]:
+    """
+    Style and render the output of `group_processes`. Does not touch any
+    widget, so that it can run in a worker thread. Also returns the ports that
+    should be forwarded according to the selection.
+    """
+    ports_to_forward = set()
+
+    groups = []
+    for group_key, members in grouped:
+        selected_by_group = group_key in selected_groups
+        plan = GroupPlan(
+            group_key, GROUP_SELECTED_STYLE if selected_by_group else "", []
+        )
+        groups.append(plan)
+
+        for process in members:
+            # selected can also be done on a node-level
+            if selected_by_group:
+                style = GROUP_SELECTED_STYLE
+            elif process.pid in selected_processes:
+                style = NODE_SELECTED_STYLE
+            else:
+                style = ""
+
+            label = render_process_label(
+                process.pid,
+                process.name,
+                process.tcp,
+                process.udp,
+                process.status,
+                style,
+            )
+            plan.rows.append((process, style, label))
+
+            if style:
+                # Add ports to forward
+                ports_to_forward.update(process.tcp)
+
+    return groups, ports_to_forward
+
 
 class ProcessTree(Tree):
     """
@@ -52,15 +184,30 @@ class ProcessTree(Tree):
         super().__init__(monitor.name)
         self.monitor: AbstractProvider = monitor
         self.last_memory: Dict[str, Process] = {}
+        self.last_version: int | None = None
         self.selected_groups: Set[str] = set()
         self.selected_processes: Set[int] = set()
         self.group_by = "cwd"
         self.sort_reverse = False
         self.filter_text = ""
         self.update_interval = 1.0
+        # polling backs off while nothing changes, up to this interval
+        self.update_interval_max = 5.0
+        self._idle_streak = 0
         self.last_update = 0
-        self.regular_update_timer: Timer | None = None
         self.logger: Log = logger
+        # nodes currently in the tree, so that layout updates can be applied
+        # as a diff instead of rebuilding the whole tree
+        self._group_nodes: Dict[str, TreeNode] = {}
+        self._proc_nodes: Dict[int, TreeNode] = {}
+        self._layout_key: tuple | None = None
+        self._last_layout_state: tuple | None = None
+        self._grouped: list[tuple[str, list[Process]]] = []
+        self._grouping_key: tuple | None = None
+        # set whenever the layout is stale; drained by layout_loop, so that
+        # bursts of changes (e.g. key repeats) result in a single update
+        self._layout_dirty = asyncio.Event()
+        self.layout_debounce = 0.05
 
     def on_mount(self) -> None:
         def expand_all(node):
@@ -75,29 +222,53 @@ class ProcessTree(Tree):
         #     self.update_interval,
         # )
 
+        self.layout_loop()
         if not self.call_later(self.update_processes):
             raise RuntimeError("Failed to schedule update_processes")
 
-    def is_new_memory(self, new_memory: Dict[str, Process]) -> bool:
-        if not self.last_memory:
-            return True
-        if len(new_memory) != len(self.last_memory):
-            return True
-        for pid, process in new_memory.items():
-            if process != self.last_memory[pid]:
-                return True
-        return False
+    async def refresh_processes(self) -> None:
+        """Poll right away (and at the base interval again) on user request."""
+        await self.monitor.refresh()
+        self._idle_streak = 0
+        # restarts the (exclusive) worker, which polls right away
+        self.update_processes()
+
+    def request_layout(self) -> None:
+        self._layout_dirty.set()
+
+    @work(group="layout")
+    async def layout_loop(self) -> None:
+        while True:
+            await self._layout_dirty.wait()
+            await asyncio.sleep(self.layout_debounce)
+            self._layout_dirty.clear()
+            await self.update_process_layout()
 
     @work(exclusive=True)
     async def update_processes(self) -> None:
-        new_memory = await self.monitor.get_processes()
-        if new_memory and self.is_new_memory(new_memory):
-            self.last_memory = new_memory.copy()
-            await self.update_process_layout()
+        changed = self.monitor.changed
+        while True:
+            # cleared before polling, so that a change made meanwhile is not lost
+            changed.clear()
+            new_memory = await self.monitor.get_processes()
+            if self.monitor.version != self.last_version:
+                self.last_version = self.monitor.version
+                self.last_memory = new_memory
+                self._idle_streak = 0
+                self.request_layout()
+            else:
+                self._idle_streak += 1
 
-        await asyncio.sleep(1)
-        # Schedule next update immediately
-        self.call_later(self.update_processes)
+            delay = min(
+                self.update_interval * 2 ** min(self._idle_streak, 8),
+                self.update_interval_max,
+            )
+            # providers that receive their updates (e.g. from a remote host)
+            # set `changed`, which ends the wait before the next poll is due
+            try:
+                await asyncio.wait_for(changed.wait(), delay)
+            except TimeoutError:
+                pass
 
     async def toggle_group(self, group_key: str) -> None:
         LOGGER.debug("Toggling group: %s", group_key)
@@ -108,119 +279,128 @@ class ProcessTree(Tree):
             self.selected_groups.remove(group_key)
         else:
             self.selected_groups.add(group_key)
-        await self.update_process_layout()
+        self.request_layout()
 
     async def toggle_process(self, pid: int) -> None:
         if pid in self.selected_processes:
             self.selected_processes.remove(pid)
         else:
             self.selected_processes.add(pid)
-        await self.update_process_layout()
+        self.request_layout()
+
+    def _remove_node(self, node: TreeNode) -> None:
+        for child in node.children:
+            if child.data and not child.data["is_group"]:
+                self._proc_nodes.pop(child.data["pid"], None)
+        node.remove()
 
     async def update_process_layout(self) -> None:
-        ports_to_forward = set()
-
-        # Group processes
-        grouped: Dict[str, list[Process]] = {}
-        for pid, process in self.last_memory.items():
-            if (
-                self.filter_text
-                and self.filter_text.lower() not in process.name.lower()
-            ):
-                continue
-            key = getattr(process, self.group_by)
-            if key not in grouped:
-                grouped[key] = []
-            grouped[key].append(process)
-
-        # Sort groups
-        sorted_groups = sorted(
-            grouped.items(),
-            key=lambda x: str(x[0]) if x[0] is not None else "",
-            reverse=self.sort_reverse,
+        # grouping, sorting and rendering the labels is done off the event
+        # loop; only applying the result touches the widgets
+        layout_key = (self.group_by, self.sort_reverse, self.filter_text)
+        # snapshot the selections, they may be toggled while the worker runs
+        selected_groups = frozenset(self.selected_groups)
+        selected_processes = frozenset(self.selected_processes)
+        layout_state = (
+            self.last_version,
+            layout_key,
+            selected_groups,
+            selected_processes,
         )
+        if layout_state == self._last_layout_state:
+            return
+        self._last_layout_state = layout_state
+
+        # the grouping only depends on the snapshot and the layout, so it is
+        # reused when only the selection changed
+        grouping_key = (self.last_version, layout_key)
+        if grouping_key != self._grouping_key:
+            self._grouped = await asyncio.to_thread(
+                group_processes, self.last_memory, *layout_key
+            )
+            self._grouping_key = grouping_key
 
-        # clear any existing nodes
-        self.clear()
+        groups, ports_to_forward = await asyncio.to_thread(
+            compute_layout, self._grouped, selected_groups, selected_processes
+        )
+        self._apply_layout(layout_key, groups)
+        self.call_later(self.update_toggled_ports, ports_to_forward)
 
-        # Create tree structure
-        for group, processes in sorted_groups:
-            group_key = str(group) if group is not None else "Unknown"
-            selected_by_group = group_key in self.selected_groups
+    def _apply_layout(self, layout_key: tuple, groups: list[GroupPlan]) -> None:
+        # changing how the tree is laid out reorders everything, so start over
+        if layout_key != self._layout_key:
+            self._layout_key = layout_key
+            self._group_nodes.clear()
+            self._proc_nodes.clear()
+            self.clear()
+
+        group_keys = {group.key for group in groups}
+        group_of_pid = {
+            process.pid: group.key for group in groups for process, _, _ in group.rows
+        }
+
+        # drop nodes that are gone, or that moved to another group, before
+        # inserting, so that the indices below line up with the remaining
+        # (already sorted) nodes
+        for group_key in self._group_nodes.keys() - group_keys:
+            self._remove_node(self._group_nodes.pop(group_key))
+        for pid, process_node in list(self._proc_nodes.items()):
+            if pid not in group_of_pid or (
+                self.group_by != "pid"
+                and process_node.parent is not self._group_nodes.get(group_of_pid[pid])
+            ):
+                self._remove_node(self._proc_nodes.pop(pid))
 
+        # Create or update tree structure
+        for group_index, group in enumerate(groups):
             if self.group_by != "pid":
-                # Create group node
-                group_node = self.root.add(group_key, expand=True)
-                group_node.data = {"is_group": True}
-
-                if selected_by_group:
-                    group_node.label.style = GROUP_SELECTED_STYLE
+                group_node = self._group_nodes.get(group.key)
+                if group_node is None:
+                    # Create group node
+                    group_node = self.root.add(
+                        Text(group.key, style=group.style),
+                        before=group_index,
+                        expand=True,
+                    )
+                    group_node.data = {"is_group": True}
+                    self._group_nodes[group.key] = group_node
+                elif group_node.label.style != group.style:
+                    group_node.set_label(Text(group.key, style=group.style))
 
                 group_or_root_node = group_node
+                index_offset = 0
             else:
                 # PID does not needs grouping.
                 group_or_root_node = self.root
-
-            # Sort processes
-            sorted_processes = sorted(
-                processes,
-                key=lambda p: str(p.pid) if p.pid is not None else "0",
-                reverse=self.sort_reverse,
-            )
-
-            for process in sorted_processes:
-                parts = []
-                if process.tcp:
-                    parts.extend(
-                        [
-                            (" 🌐", "bold cyan"),
-                            ("TCP", "bold cyan u"),
-                            (": ", "bold cyan"),
-                            f"{','.join(map(str, process.tcp))}",
-                        ]
-                    )
-                if process.udp:
-                    parts.append((" 📡UDP: ", "bold red"))
-                    parts.append(f"{','.join(map(str, process.udp))}")
-
-                process_node = group_or_root_node.add_leaf(
-                    Text.assemble(
-                        ("🆔", ""),
-                        (f"{process.pid}", "bold"),
-                        (" 📦", ""),
-                        (f"{process.name}", "blue"),
-                        *parts,
-                        (f" (⚡{process.status})", ""),
-                        overflow="ellipsis",
-                        justify="center",
-                    )
-                )
-                # Add process node
-                process_node.data = {"is_group": False, "pid": process.pid}
-
-                # selected can also be done on a node-level
-                if selected_by_group:
-                    process_node.label.style = GROUP_SELECTED_STYLE
-                elif process.pid in self.selected_processes:
-                    process_node.label.style = NODE_SELECTED_STYLE
-                else:
-                    continue
-
-                # Add ports to forward
-                for p in process.tcp:
-                    ports_to_forward.add(p)
-
-        self.call_later(self.update_toggled_ports, ports_to_forward)
-
-    @work(exclusive=True)
+                index_offset = group_index
+
+            for index, (process, style, label) in enumerate(group.rows, index_offset):
+                process_node = self._proc_nodes.get(process.pid)
+                if process_node is None:
+                    # Add process node
+                    process_node = group_or_root_node.add_leaf(label, before=index)
+                    self._proc_nodes[process.pid] = process_node
+                elif (
+                    process_node.data["process"] is not process
+                    or process_node.data["style"] != style
+                ):
+                    process_node.set_label(label)
+                process_node.data = {
+                    "is_group": False,
+                    "pid": process.pid,
+                    "process": process,
+                    "style": style,
+                }
+
+    @work(exclusive=True, group="ports")
     async def update_toggled_ports(self, ports_to_forward: Set[int]) -> None:
         await self.monitor.set_toggled_ports(ports_to_forward)
 
     async def on_unmount(self) -> None:
         """Clean up all port forwarding processes when the widget is removed."""
 
-        if self.regular_update_timer:
-            self.regular_update_timer.stop()
+        # stop polling (update_processes runs in the default group)
+        self.workers.cancel_group(self, "default")
 
         await self.monitor.cleanup()
 
@@ -228,15 +408,15 @@ class ProcessTree(Tree):
         options = ["cwd", "name", "pid"]
         current_index = options.index(self.group_by)
         self.group_by = options[(current_index + 1) % len(options)]
-        await self.update_process_layout()
+        self.request_layout()
 
     async def toggle_sort(self) -> None:
         self.sort_reverse = not self.sort_reverse
-        await self.update_process_layout()
+        self.request_layout()
 
     async def set_filter(self, text: str) -> None:
         self.filter_text = text
-        await self.update_process_layout()
+        self.request_layout()
 
 
 class TuiLogHandler(logging.Handler):
@@ -249,18 +429,44 @@ class TuiLogHandler(logging.Handler):
             super().__init__()
             self.msg = msg
 
-    def __init__(self, tui_logger: Log):
+    def __init__(self, tui_logger: Log, flush_delay: float = 0.05):
         super().__init__()
         self.tui_logger = tui_logger
         self._lock = threading.Lock()
+        # records are buffered and written in one go, so that a burst of logs
+        # (possibly from other threads) costs one message and one repaint;
+        # lines the log widget would drop anyway are not kept
+        self._buffer: deque[str] = deque(maxlen=tui_logger.max_lines)
+        self._flush_scheduled = False
+        self._flush_delay = flush_delay
+        self._loop = asyncio.get_running_loop()
 
     def emit(self, record):
+        if self._loop.is_closed():
+            # e.g. logged by atexit cleanups after the app has exited
+            return
         msg = self.format(record)
+        with self._lock:
+            self._buffer.append(msg)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
         try:
-            self.tui_logger.post_message(self.NewLog(msg))
+            self._loop.call_soon_threadsafe(
+                self._loop.call_later, self._flush_delay, self._flush
+            )
         except Exception:
+            with self._lock:
+                self._flush_scheduled = False
             self.handleError(record)
 
+    def _flush(self) -> None:
+        with self._lock:
+            msg = "\n".join(self._buffer)
+            self._buffer.clear()
+            self._flush_scheduled = False
+        self.tui_logger.post_message(self.NewLog(msg))
+
 
 class ProcessMonitor(App):
     CSS = """
@@ -281,31 +487,33 @@ class ProcessMonitor(App):
         Binding("s", "toggle_sort", "Toggle Sort"),
         Binding("f", "filter", "Filter"),
         Binding("t", "toggle_group", "Toggle Group"),
+        Binding("r", "refresh", "Refresh"),
         Binding("q", "quit", "Quit"),
     ]
 
-    def __init__(self, monitor: RemoteProcessMonitor):
+    def __init__(self, monitor: AbstractProvider):
         super().__init__()
         self.monitor = monitor
         self.logger = Log(id="log-widget", max_lines=50)
         self.process_tree = ProcessTree(monitor, self.logger)
+        self.tui_log_handler: TuiLogHandler | None = None
 
     @on(TuiLogHandler.NewLog)
     def handle_new_log(self, message: TuiLogHandler.NewLog) -> None:
         """
         These messages are bubbled up from the TUILogHandler.
         """
-        self.logger.write_line(message.msg)
+        self.logger.write_lines(message.msg.splitlines())
 
     def on_mount(self) -> None:
         # Attach TUI log handler
-        tui_log_handler = TuiLogHandler(self.logger)
-        tui_log_handler.setLevel(logging.DEBUG)
-        tui_log_handler.setFormatter(FORMATTER)
+        self.tui_log_handler = TuiLogHandler(self.logger)
+        self.tui_log_handler.setLevel(logging.DEBUG)
+        self.tui_log_handler.setFormatter(FORMATTER)
 
         # Add handler to root logger to capture all logs
         root_logger = logging.getLogger()
-        root_logger.addHandler(tui_log_handler)
+        root_logger.addHandler(self.tui_log_handler)
         self.post_message(TuiLogHandler.NewLog("[Log Area]"))
 
     def compose(self) -> ComposeResult:
@@ -321,6 +529,9 @@ class ProcessMonitor(App):
         await self.monitor.cleanup()
         await self.process_tree.toggle_sort()
 
+    async def action_refresh(self) -> None:
+        await self.process_tree.refresh_processes()
+
     def action_filter(self) -> None:
         self.app.push_screen(FilterScreen(self.process_tree))
 
@@ -351,23 +562,63 @@ class ProcessMonitor(App):
 
     async def on_unmount(self) -> None:
         """Clean up resources when the app is closed."""
-        await self.monitor.cleanup()
+        try:
+            await self.monitor.cleanup()
+        finally:
+            # it writes to the event loop of the app, which is about to close
+            if self.tui_log_handler is not None:
+                logging.getLogger().removeHandler(self.tui_log_handler)
+                self.tui_log_handler = None
+
+
+class FilterScreen(ModalScreen):
+    """
+    Edit the process name filter. The tree follows the input as it is typed,
+    debounced so that a burst of keystrokes only updates the layout once.
+    """
 
+    DEFAULT_CSS = """
+    FilterScreen {
+        align: center middle;
+    }
+    FilterScreen > Vertical {
+        width: 60;
+        height: auto;
+        border: round $accent;
+        background: $panel;
+    }
+    """
+
+    BINDINGS = [Binding("escape", "cancel", "Cancel")]
 
-class FilterScreen(App):
     def __init__(self, process_tree: ProcessTree):
         super().__init__()
         self.process_tree = process_tree
+        self._original_filter = process_tree.filter_text
+        self._filter_timer: Timer | None = None
 
     def compose(self) -> ComposeResult:
-        yield Static("Enter filter text:")
-        yield Static(self.process_tree.filter_text)
-
-    async def on_key(self, event):
-        if event.key == "escape":
-            self.app.pop_screen()
-        elif event.key == "enter":
-            await self.process_tree.set_filter(self.process_tree.filter_text)
-            self.app.pop_screen()
-        else:
-            self.process_tree.filter_text += event.character
+        with Vertical():
+            yield Static("Enter filter text:")
+            yield Input(value=self.process_tree.filter_text)
+
+    def _stop_filter_timer(self) -> None:
+        if self._filter_timer is not None:
+            self._filter_timer.stop()
+            self._filter_timer = None
+
+    def on_input_changed(self, event: Input.Changed) -> None:
+        self._stop_filter_timer()
+        self._filter_timer = self.set_timer(
+            0.15, partial(self.process_tree.set_filter, event.value)
+        )
+
+    async def on_input_submitted(self, event: Input.Submitted) -> None:
+        self._stop_filter_timer()
+        await self.process_tree.set_filter(event.value)
+        self.app.pop_screen()
+
+    async def action_cancel(self) -> None:
+        self._stop_filter_timer()
+        await self.process_tree.set_filter(self._original_filter)
+        self.app.pop_screen()
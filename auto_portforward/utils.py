@@ -1,22 +1,258 @@
+import asyncio
+import logging
 import os
+import selectors
+import shutil
 import signal
+import subprocess
 import sys
+import threading
 import ctypes
 
+from functools import partial
+from pathlib import Path
+from typing import IO
+
+# Directory holding the ssh ControlMaster sockets (one per destination).
+SSH_CONTROL_DIR = Path.home() / ".cache" / "auto-portforward"
+
+# util-linux launcher that sets the parent death signal before exec'ing
+SETPRIV = shutil.which("setpriv") if sys.platform.startswith("linux") else None
+
+PR_SET_PDEATHSIG = 1
+# loaded once, set_pdeathsig runs in every forked child
+if sys.platform.startswith("linux"):
+    _LIBC = ctypes.CDLL("libc.so.6", use_errno=True)
+    _LIBC.prctl.argtypes = (ctypes.c_int, ctypes.c_ulong)
+    _LIBC.prctl.restype = ctypes.c_int
+else:
+    _LIBC = None
+
 
 def set_pdeathsig(sig=signal.SIGTERM):
     """Set parent death signal on Linux so child dies if parent dies."""
-    if sys.platform.startswith("linux"):
-        libc = ctypes.CDLL("libc.so.6")
-        return libc.prctl(1, sig)
+    if _LIBC is not None:
+        return _LIBC.prctl(PR_SET_PDEATHSIG, sig)
     return 0
 
 
 def preexec_set_pdeathsig():
-    # Set the process group ID to the current process ID.
-    os.setpgrp()
-    # Set the session ID to the current process ID.
-    # the following is done via the popen call
-    # os.setsid()
+    # Set the process group ID to the current process ID, unless Popen already
+    # made us a session (and thus group) leader with start_new_session=True,
+    # in which case setpgrp() would fail with EPERM.
+    if os.getpgrp() != os.getpid():
+        os.setpgrp()
     # Set the parent death signal to the current process ID.
     set_pdeathsig(signal.SIGTERM)
+
+
+def popen_in_own_group(command: list[str], **kwargs) -> subprocess.Popen:
+    """
+    Popen `command` in its own process group, SIGTERM'ed when we die.
+
+    Without a preexec_fn, Popen can use its vfork/posix_spawn fast path and
+    skips running Python code in the forked child, so the parent death signal
+    is set by `setpriv` instead. preexec_set_pdeathsig is only the fallback
+    for Linux systems that lack it.
+    """
+    if not kwargs.get("start_new_session"):
+        kwargs["process_group"] = 0
+    if SETPRIV is not None:
+        command = [SETPRIV, "--pdeathsig", "TERM", "--", *command]
+    elif sys.platform.startswith("linux"):
+        kwargs.pop("process_group", None)
+        kwargs["preexec_fn"] = preexec_set_pdeathsig
+    return subprocess.Popen(command, **kwargs)
+
+
+def _group_killer(process: subprocess.Popen):
+    """Signal sender for the process group of `process`, None if it is gone."""
+    if process.poll() is not None:
+        return None
+    try:
+        pgid = os.getpgid(process.pid)
+    except ProcessLookupError:
+        return None
+    if pgid == os.getpgrp():
+        # never signal our own group
+        return process.send_signal
+    return partial(os.killpg, pgid)
+
+
+def terminate_process_group(process: subprocess.Popen, timeout: float = 0.1) -> None:
+    """
+    Send one SIGTERM to the process group of `process` (which has its own, see
+    popen_in_own_group), and SIGKILL it if it is still there after `timeout`.
+    """
+    kill = _group_killer(process)
+    if kill is None:
+        return
+    try:
+        kill(signal.SIGTERM)
+        process.wait(timeout=timeout)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        kill(signal.SIGKILL)
+        process.wait()
+
+
+async def terminate_process_group_async(
+    process: subprocess.Popen, timeout: float = 0.1
+) -> None:
+    """
+    terminate_process_group() for the event loop. The exit is awaited through a
+    pidfd registered with the loop rather than by polling in a thread; where
+    pidfds are not available it falls back to the latter.
+    """
+    kill = _group_killer(process)
+    if kill is None:
+        return
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        await asyncio.to_thread(terminate_process_group, process, timeout)
+        return
+
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def on_exit():
+        # the pidfd stays readable, so this can run more than once
+        if not exited.done():
+            exited.set_result(None)
+
+    loop.add_reader(pidfd, on_exit)
+    try:
+        kill(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(exited), timeout)
+        except TimeoutError:
+            kill(signal.SIGKILL)
+            await exited
+    except ProcessLookupError:
+        pass
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    # already exited, so this only reaps it
+    process.wait()
+
+
+def ssh_control_options() -> list[str]:
+    """
+    Options that make every ssh call to the same host share one authenticated
+    master connection, so only the first call pays for the TCP + KEX + auth
+    handshake.
+    """
+    SSH_CONTROL_DIR.mkdir(parents=True, exist_ok=True)
+    return [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={SSH_CONTROL_DIR}/cm-%C",
+        "-o",
+        "ControlPersist=600",
+        # keep the master alive through NAT timeouts
+        "-o",
+        "ServerAliveInterval=30",
+    ]
+
+
+async def close_ssh_control_master(ssh_host: str) -> None:
+    """
+    Ask the master connection of `ssh_host` (if any) to exit, without blocking
+    the event loop while ssh talks to it.
+    """
+    process = await asyncio.create_subprocess_exec(
+        "ssh",
+        *ssh_control_options(),
+        "-O",
+        "exit",
+        ssh_host,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        await asyncio.wait_for(process.wait(), timeout=5)
+    except TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+
+
+class PipeLogger:
+    """
+    Logs what our ssh children write to their stdout/stderr pipes. All pipes
+    are watched by one selector thread, instead of one blocked thread per pipe.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        # written to so that select() picks up newly added pipes
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._pending: list[tuple[IO, logging.Logger, int, str]] = []
+
+    def add(self, pipe: IO, logger: logging.Logger, level: int, prefix: str) -> None:
+        """Log every line read from `pipe` as `prefix + line`, until it is closed."""
+        with self._lock:
+            self._pending.append((pipe, logger, level, prefix))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="pipe-logger", daemon=True
+                )
+                self._thread.start()
+        os.write(self._wakeup_w, b"\0")
+
+    def _register_pending(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for pipe, logger, level, prefix in pending:
+            os.set_blocking(pipe.fileno(), False)
+            self._selector.register(
+                pipe, selectors.EVENT_READ, (logger, level, prefix, bytearray())
+            )
+
+    def _run(self) -> None:
+        while True:
+            for key, _ in self._selector.select():
+                if key.fd == self._wakeup_r:
+                    os.read(self._wakeup_r, 4096)
+                    self._register_pending()
+                    continue
+                logger, level, prefix, buffered = key.data
+                try:
+                    chunk = os.read(key.fd, 65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    chunk = b""
+                if not chunk:
+                    # the child is gone
+                    if buffered and logger.isEnabledFor(level):
+                        logger.log(
+                            level, "%s%s", prefix, buffered.decode(errors="replace")
+                        )
+                    self._selector.unregister(key.fileobj)
+                    continue
+                buffered += chunk
+                if b"\n" not in chunk:
+                    continue
+                if not logger.isEnabledFor(level):
+                    # only keep the start of the next line
+                    del buffered[: buffered.rfind(b"\n") + 1]
+                    continue
+                *lines, rest = buffered.split(b"\n")
+                buffered[:] = rest
+                for line in lines:
+                    logger.log(
+                        level, "%s%s", prefix, line.decode(errors="replace").rstrip()
+                    )
+
+
+PIPE_LOGGER = PipeLogger()
@@ -0,0 +1,19 @@
+from auto_portforward.process_provider import get_process_with_openports
+
+
+def test_drop_client_udp_sockets(monkeypatch):
+    monkeypatch.setattr(
+        get_process_with_openports, "_ephemeral_ports", range(32768, 61000)
+    )
+    inodes = {
+        "1": ("udp", 53),
+        "2": ("udp", 5353),
+        "3": ("udp", 40000),
+        # only UDP is filtered; TCP listeners may use any port
+        "4": ("tcp", 40001),
+    }
+    assert get_process_with_openports.drop_client_udp_sockets(inodes) == {
+        "1": ("udp", 53),
+        "2": ("udp", 5353),
+        "4": ("tcp", 40001),
+    }
@@ -0,0 +1,75 @@
+from auto_portforward.datatype import Process
+from auto_portforward.process_provider.script_on_remote_machine import (
+    diff_snapshots,
+    dump_message,
+)
+from auto_portforward.process_provider.ssh_remote import apply_message, json_loads
+
+
+def remote_process(pid: int, status: str = "running", tcp=(8000,), udp=()) -> dict:
+    # what get_listening_processes produces on the remote in single file mode
+    return {
+        "pid": pid,
+        "name": f"proc{pid}",
+        "cwd": "/srv",
+        "status": status,
+        "create_time": "0",
+        "tcp": list(tcp),
+        "udp": list(udp),
+    }
+
+
+def local_process(pid: int, status: str = "running", tcp=(8000,), udp=()) -> Process:
+    return Process(
+        pid=pid,
+        name=f"proc{pid}",
+        cwd="/srv",
+        status=status,
+        create_time="0",
+        tcp=tuple(tcp),
+        udp=tuple(udp),
+    )
+
+
+def over_the_wire(message: dict) -> dict:
+    return json_loads(dump_message(message))
+
+
+def test_snapshot_then_deltas_round_trip():
+    first = {"1": remote_process(1), "2": remote_process(2, udp=(53,))}
+    processes = apply_message(
+        over_the_wire({"type": "snapshot", "processes": first}), {}
+    )
+    assert processes == {"1": local_process(1), "2": local_process(2, udp=(53,))}
+
+    # pid 3 added, pid 1 changed, pid 2 removed
+    second = {"1": remote_process(1, status="sleeping"), "3": remote_process(3)}
+    delta = diff_snapshots(first, second)
+    assert delta == {
+        "type": "delta",
+        "added": {"3": second["3"]},
+        "changed": {"1": second["1"]},
+        "removed": ["2"],
+    }
+    updated = apply_message(over_the_wire(delta), processes)
+    assert updated == {"1": local_process(1, status="sleeping"), "3": local_process(3)}
+    # a dict that has been handed out is never mutated
+    assert processes == {"1": local_process(1), "2": local_process(2, udp=(53,))}
+
+    # unchanged processes keep their objects
+    third = {**second, "4": remote_process(4, tcp=(80, 443))}
+    again = apply_message(over_the_wire(diff_snapshots(second, third)), updated)
+    assert again["1"] is updated["1"]
+    assert again["3"] is updated["3"]
+    assert again["4"] == local_process(4, tcp=(80, 443))
+
+
+def test_no_delta_when_nothing_changed():
+    snapshot = {"1": remote_process(1)}
+    assert diff_snapshots(snapshot, {"1": remote_process(1)}) is None
+
+
+def test_repeated_snapshot_is_no_change():
+    snapshot = {"type": "snapshot", "processes": {"1": remote_process(1)}}
+    processes = apply_message(over_the_wire(snapshot), {})
+    assert apply_message(over_the_wire(snapshot), processes) is None
@@ -0,0 +1,76 @@
+import asyncio
+
+from auto_portforward.datatype import Process
+from auto_portforward.process_provider.abstract_provider import BaseProvider
+from auto_portforward.tui import ProcessMonitor, compute_layout, group_processes
+
+
+class StaticProvider(BaseProvider):
+    async def get_processes(self) -> dict[str, Process]:
+        return {}
+
+
+def make_process(pid: int, cwd: str) -> Process:
+    return Process(
+        pid=pid, name=f"proc{pid}", cwd=cwd, status="running", create_time="0"
+    )
+
+
+def apply(tree, processes: list[Process]) -> None:
+    layout_key = (tree.group_by, tree.sort_reverse, tree.filter_text)
+    grouped = group_processes({str(p.pid): p for p in processes}, *layout_key)
+    groups, _ = compute_layout(grouped, frozenset(), frozenset())
+    tree._apply_layout(layout_key, groups)
+
+
+def rendered(tree) -> list[tuple[str, list[int]]]:
+    return [
+        (str(group.label), [child.data["pid"] for child in group.children])
+        for group in tree.root.children
+    ]
+
+
+def test_group_processes_filters_and_sorts():
+    processes = {
+        str(p.pid): p
+        for p in (make_process(3, "/b"), make_process(2, "/a"), make_process(1, "/b"))
+    }
+    grouped = group_processes(processes, "cwd", False, "")
+    assert [(key, [p.pid for p in members]) for key, members in grouped] == [
+        ("/a", [2]),
+        ("/b", [1, 3]),
+    ]
+
+    grouped = group_processes(processes, "cwd", True, "PROC3")
+    assert [(key, [p.pid for p in members]) for key, members in grouped] == [
+        ("/b", [3]),
+    ]
+
+
+def test_apply_layout_moves_process_between_groups():
+    async def run():
+        app = ProcessMonitor(StaticProvider())
+        async with app.run_test() as pilot:
+            # let the initial (empty) layout go through first
+            await pilot.pause(0.2)
+            tree = app.process_tree
+
+            apply(
+                tree,
+                [make_process(1, "/a"), make_process(2, "/a"), make_process(9, "/b")],
+            )
+            assert rendered(tree) == [("/a", [1, 2]), ("/b", [9])]
+
+            # pid 1 moves to /b while pid 3 is inserted into /a
+            apply(
+                tree,
+                [
+                    make_process(1, "/b"),
+                    make_process(2, "/a"),
+                    make_process(3, "/a"),
+                    make_process(9, "/b"),
+                ],
+            )
+            assert rendered(tree) == [("/a", [2, 3]), ("/b", [1, 9])]
+
+    asyncio.run(run())